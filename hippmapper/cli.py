@@ -4,18 +4,13 @@
 
 import argcomplete
 import argparse
+import importlib
 import logging
 import os
 import sys
 import warnings
 
 from hippmapper import __version__
-from hippmapper import gui
-from hippmapper.segment import hippmapper
-from hippmapper.convert import filetype
-from hippmapper.preprocess import biascorr, trim_like
-from hippmapper.qc import seg_qc, reg_svg
-from hippmapper.stats import summary_hp_vols
 from hippmapper.utils.path_manager import add_paths
 
 warnings.simplefilter("ignore")
@@ -27,102 +22,131 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
 
 # --------------
 # functions
+# (modules are imported when their subcommand runs, so the cli does not pay for TensorFlow, Qt, nipype ...
+# when it is not needed)
 
 
 def run_filetype(args):
+    from hippmapper.convert import filetype
     filetype.main(args)
 
 
 def run_hippmapper(args):
-    hippmapper.main(args)
+    from hippmapper.segment import serve
+
+    # submit to a running daemon (models already loaded) if there is one
+    if not args.local and serve.daemon_available():
+        result = serve.submit(args)
+        if result['status'] != 'done':
+            sys.exit(1)
+    else:
+        from hippmapper.segment import hippmapper
+        hippmapper.main(args)
+
+
+def run_serve(args):
+    from hippmapper.segment import serve
+    serve.main(args)
 
 
 def run_hp_seg_summary(args):
+    from hippmapper.stats import summary_hp_vols
     summary_hp_vols.main(args)
 
 
+def run_tune(args):
+    from hippmapper.deep import tune
+    tune.main(args)
+
+
 def run_seg_qc(args):
+    from hippmapper.qc import seg_qc
     seg_qc.main(args)
 
 def run_reg_svg(args):
+    from hippmapper.qc import reg_svg
     reg_svg.main(args)
 
 def run_utils_biascorr(args):
+    from hippmapper.preprocess import biascorr
     biascorr.main(args)
 
 
 def run_trim_like(args):
+    from hippmapper.preprocess import trim_like
     trim_like.main(args)
 
 # --------------
 # parser
 
-
-def get_parser():
+# subcommand: module with its parser (parsefn), run function, help, usage (parser usage if None)
+SUBCOMMANDS = [
+    ('seg_hipp', 'hippmapper.segment.hippmapper', run_hippmapper, "Segment hippocampus using a trained CNN", None),
+    ('serve', 'hippmapper.segment.serve', run_serve,
+     "Run a local segmentation daemon keeping the models loaded", None),
+    ('tune', 'hippmapper.deep.tune', run_tune, "Benchmark thread counts and MC batch sizes on this machine", None),
+    ('seg_qc', 'hippmapper.qc.seg_qc', run_seg_qc,
+     "Create tiled mosaic of segmentation overlaid on structural image", None),
+    ('reg_svg', 'hippmapper.qc.reg_svg', run_reg_svg, None, None),
+    ('bias_corr', 'hippmapper.preprocess.biascorr', run_utils_biascorr, "Bias field correct images using N4", None),
+    ('filetype', 'hippmapper.convert.filetype', run_filetype, "Convert the Analyse format to Nifti", None),
+    ('stats_hp', 'hippmapper.stats.summary_hp_vols', run_hp_seg_summary,
+     "Generates volumetric summary of hippocampus segmentations", None),
+    ('trim_like', 'hippmapper.preprocess.trim_like', run_trim_like,
+     'Trim or expand image in same space like reference',
+     '%(prog)s -i [ img ] -r [ ref ] -o [ out ] \n\nTrim or expand image in same space like reference'),
+]
+
+
+# subcommands whose thread options also set the math library threads (see preset_math_threads)
+MATH_THREAD_SUBCOMMANDS = ('seg_hipp', 'serve')
+
+
+def preset_math_threads(args):
+    """
+    Set OpenMP / MKL threads asked for by a subcommand (--omp_threads, else --intra_threads) before its module
+    imports numpy and TensorFlow, as the math libraries read them when they load
+    :param args: command line arguments
+    """
+    if args[:1] and args[0] not in MATH_THREAD_SUBCOMMANDS:
+        return
+
+    thread_parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    thread_parser.add_argument('-ita', '--intra_threads', type=int)
+    thread_parser.add_argument('-omp', '--omp_threads', type=int)
+    try:
+        thread_args, _ = thread_parser.parse_known_args(args[1:])
+    except SystemExit:
+        # invalid values are reported by the subcommand parser
+        return
+
+    omp_threads = thread_args.intra_threads if thread_args.omp_threads is None else thread_args.omp_threads
+    if omp_threads is not None:
+        from hippmapper.deep.session import set_math_threads
+        set_math_threads(omp_threads)
+
+
+def get_parser(args=None):
+    """
+    Build cli parser. Only the module of the subcommand being run is imported for its options,
+    other subcommands are listed by name and help (all are built for shell completion)
+    :param args: command line arguments (all subcommands are built if None)
+    :return: parser
+    """
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()
-    # --------------
-
-    # seg hippocampus (hipp)
-    hipp_parser = hippmapper.parsefn()
-    parser_seg_hipp = subparsers.add_parser('seg_hipp', add_help=False, parents=[hipp_parser],
-                                            help="Segment hippocampus using a trained CNN",
-                                            usage=hipp_parser.usage)
-    parser_seg_hipp.set_defaults(func=run_hippmapper)
-
-    # --------------
-
-    # seg qc
-    seg_qc_parser = seg_qc.parsefn()
-    parser_seg_qc = subparsers.add_parser('seg_qc', add_help=False, parents=[seg_qc_parser],
-                                          help="Create tiled mosaic of segmentation overlaid on structural image",
-                                          usage=seg_qc_parser.usage)
-    parser_seg_qc.set_defaults(func=run_seg_qc)
-
-		# --------------
-    
-    # reg_svg
-    reg_svg_parser = reg_svg.parsefn()
-    parser_reg_svg = subparsers.add_parser('reg_svg', add_help=False, parents=[reg_svg_parser], usage=reg_svg_parser.usage)
-    parser_reg_svg.set_defaults(func=run_reg_svg)
-
-    # --------------
-
-    # utils biascorr
-    biascorr_parser = biascorr.parsefn()
-    parser_utils_biascorr = subparsers.add_parser('bias_corr', add_help=False, parents=[biascorr_parser],
-                                                  help="Bias field correct images using N4",
-                                                  usage=biascorr_parser.usage)
-    parser_utils_biascorr.set_defaults(func=run_utils_biascorr)
-
-    # --------------
-
-    # filetype
-    filetype_parser = filetype.parsefn()
-    parser_filetype = subparsers.add_parser('filetype', add_help=False, parents=[filetype_parser],
-                                            help="Convert the Analyse format to Nifti",
-                                            usage=filetype_parser.usage)
-    parser_filetype.set_defaults(func=run_filetype)
-
-    # --------------
-
-    # hipp vol seg
-    hp_vol_parser = summary_hp_vols.parsefn()
-    parser_stats_hp = subparsers.add_parser('stats_hp', add_help=False, parents=[hp_vol_parser],
-                                            help="Generates volumetric summary of hippocampus segmentations",
-                                            usage=hp_vol_parser.usage)
-    parser_stats_hp.set_defaults(func=run_hp_seg_summary)
-
-    # --------------
-
-    # trim like
-    trim_parser = trim_like.parsefn()
-
-    parser_trim_like = subparsers.add_parser('trim_like', help='Trim or expand image in same space like reference',
-                                             add_help=False, parents=[trim_parser],
-                                             usage='%(prog)s -i [ img ] -r [ ref ] -o [ out ] \n\n'
-                                                   'Trim or expand image in same space like reference')
-    parser_trim_like.set_defaults(func=run_trim_like)
+
+    build_all = args is None or '_ARGCOMPLETE' in os.environ
+
+    for name, module_name, func, help_str, usage in SUBCOMMANDS:
+        if build_all or name in args[:1]:
+            sub_parser = importlib.import_module(module_name).parsefn()
+            parser_sub = subparsers.add_parser(name, add_help=False, parents=[sub_parser],
+                                               usage=usage or sub_parser.usage,
+                                               **({'help': help_str} if help_str else {}))
+        else:
+            parser_sub = subparsers.add_parser(name, **({'help': help_str} if help_str else {}))
+        parser_sub.set_defaults(func=func)
 
     # --------------------
 
@@ -141,7 +165,8 @@ def main(args=None):
     if args is None:
         args = sys.argv[1:]
 
-    parser = get_parser()
+    preset_math_threads(args)
+    parser = get_parser(args)
     argcomplete.autocomplete(parser)
     args = parser.parse_args(args)
 
@@ -149,6 +174,7 @@ def main(args=None):
 
         # set filename, file path for the log file
         log_filename = args.func.__name__.split('run_')[1]
+        log_filepath = os.path.join(os.getcwd(), '{}.log'.format(log_filename))
         if hasattr(args, 'subj'):
             if args.subj:
                 log_filepath = os.path.join(args.subj, 'logs', '{}.log'.format(log_filename))
@@ -157,9 +183,6 @@ def main(args=None):
                 if args.t1w:
                     log_filepath = os.path.join(os.path.dirname(args.t1w), 'logs', '{}.log'.format(log_filename))
 
-        else:
-            log_filepath = os.path.join(os.getcwd(), '{}.log'.format(log_filename))
-
         os.makedirs(os.path.dirname(log_filepath), exist_ok=True)
 
         # log keeps console output and redirects to file
@@ -173,6 +196,7 @@ def main(args=None):
             args.func(args)
 
     else:
+        from hippmapper import gui
         gui.main()
 
 
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import os
+import sys
+import copy
+import json
+import argcomplete
+import argparse
+import numpy as np
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
+
+# layers with an axis argument (channel axis moves from 1 to -1)
+AXIS_LAYERS = ('InstanceNormalization', 'BatchNormalization', 'Concatenate', 'Softmax')
+
+# layers whose behaviour depends on the memory layout in ways that cannot be converted from the config
+UNSUPPORTED_LAYERS = ('Reshape', 'Permute', 'Flatten', 'Dense', 'Lambda')
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage="%(prog)s -j [ model json ] -w [ model weights ] \n\n"
+                                           "Convert a channels-first model to channels-last (faster CPU convolutions) "
+                                           "and check that both give the same outputs\n\n"
+                                           "Examples: \n"
+                                           "    python -m hippmapper.deep.convert_channels_last "
+                                           "-j models/hipp_model.json -w models/hipp_model_weights.h5 \n")
+
+    required = parser.add_argument_group('required arguments')
+
+    required.add_argument('-j', '--json', type=str, metavar='', help="model architecture (json)", required=True)
+    required.add_argument('-w', '--weights', type=str, metavar='', help="model weights (h5)", required=True)
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-t', '--tol', type=float, metavar='', default=1e-4,
+                          help="max absolute difference allowed between outputs (default: %(default)s)")
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    assert os.path.exists(args.json), "%s does not exist ... please check path and rerun script" % args.json
+    assert os.path.exists(args.weights), "%s does not exist ... please check path and rerun script" % args.weights
+
+    return args.json, args.weights, args.tol
+
+
+def channels_last_files(model_json, model_weights):
+    """
+    Files of the channels-last version of a model (named like save_weights: <name>.json, <name>_weights.h5)
+    :param model_json: model architecture (json)
+    :param model_weights: model weights (h5)
+    :return: channels-last json, channels-last weights
+    """
+    model_name = model_json[:-len('.json')] if model_json.endswith('.json') else model_json
+    return '%s_cl.json' % model_name, '%s_cl_weights.h5' % model_name
+
+
+def _convert_axis(axis, ndim):
+    if axis is None:
+        return None
+    if isinstance(axis, (list, tuple)):
+        return [_convert_axis(ax, ndim) for ax in axis]
+    # (batch, channels, spatial...) -> (batch, spatial..., channels)
+    axis = axis % ndim
+    if axis == 0:
+        return 0
+    return -1 if axis == 1 else axis - 1
+
+
+def convert_model_config(model_config, ndim=5):
+    """
+    Rewrite a channels-first keras model config to channels-last
+    :param model_config: model config (from model.get_config() or the 'config' of the model json)
+    :param ndim: rank of the image tensors (5 for 3D images)
+    :return: channels-last model config
+    """
+    model_config = copy.deepcopy(model_config)
+
+    for layer in model_config['layers']:
+        layer_class, config = layer['class_name'], layer['config']
+
+        if layer_class in UNSUPPORTED_LAYERS:
+            raise ValueError("layer %s (%s) cannot be converted to channels-last" % (config.get('name'), layer_class))
+
+        if layer_class == 'InputLayer':
+            shape = list(config['batch_input_shape'])
+            config['batch_input_shape'] = [shape[0]] + shape[2:] + [shape[1]]
+
+        if 'data_format' in config:
+            config['data_format'] = 'channels_last'
+
+        if layer_class in AXIS_LAYERS and 'axis' in config:
+            config['axis'] = _convert_axis(config['axis'], ndim)
+
+    return model_config
+
+
+def deterministic_config(model_config):
+    """
+    Model config with dropout forced off (training=True call arguments removed), to compare outputs
+    :param model_config: model config
+    :return: model config
+    """
+    model_config = copy.deepcopy(model_config)
+
+    for layer in model_config['layers']:
+        for node in layer.get('inbound_nodes', []):
+            for inbound in node:
+                if len(inbound) > 3 and isinstance(inbound[3], dict):
+                    inbound[3].pop('training', None)
+
+    return model_config
+
+
+def to_channels_last(data):
+    """(n, channels, x, y, z) -> (n, x, y, z, channels)"""
+    return np.moveaxis(data, 1, -1)
+
+
+def to_channels_first(data):
+    """(n, x, y, z, channels) -> (n, channels, x, y, z)"""
+    return np.moveaxis(data, -1, 1)
+
+
+def is_channels_last(model):
+    """
+    Check if model expects channels-last inputs
+    :param model: keras model
+    :return: True if channels-last
+    """
+    if hasattr(model, 'channels_last'):
+        # frozen graph
+        return model.channels_last
+
+    data_formats = set(layer.get_config().get('data_format') for layer in model.layers) - {None}
+    return data_formats == {'channels_last'}
+
+
+def _model_from_config(class_name, model_config):
+    from hippmapper.deep.predict import load_old_model_json
+    return load_old_model_json(json.dumps({'class_name': class_name, 'config': model_config}))
+
+
+def convert_model(model_json, model_weights, tol=1e-4):
+    """
+    Convert model to channels-last, check outputs match and save it next to the original
+    (conv kernels are stored in the same layout for both data formats, so weights carry over unchanged)
+    :param model_json: model architecture (json)
+    :param model_weights: model weights (h5)
+    :param tol: max absolute difference allowed between outputs
+    :return: channels-last json, channels-last weights, max absolute difference
+    """
+    with open(model_json, 'r') as json_file:
+        model_def = json.load(json_file)
+
+    class_name, config = model_def['class_name'], model_def['config']
+    cl_config = convert_model_config(config)
+
+    # compare deterministic versions of both models on a random input
+    model = _model_from_config(class_name, deterministic_config(config))
+    model.load_weights(model_weights)
+    cl_model = _model_from_config(class_name, deterministic_config(cl_config))
+    cl_model.set_weights(model.get_weights())
+
+    input_shape = [1] + list(config['layers'][0]['config']['batch_input_shape'][1:])
+    test_data = np.random.randn(*input_shape).astype(np.float32)
+
+    diff = np.max(np.abs(model.predict(test_data) - to_channels_first(cl_model.predict(to_channels_last(test_data)))))
+    if diff > tol:
+        raise ValueError("channels-last model output differs by %s (tolerance %s)" % (diff, tol))
+
+    cl_json, cl_weights = channels_last_files(model_json, model_weights)
+
+    with open(cl_json, 'w') as json_file:
+        json.dump({'class_name': class_name, 'config': cl_config, 'keras_version': model_def.get('keras_version'),
+                   'backend': model_def.get('backend')}, json_file)
+    cl_model.save_weights(cl_weights)
+
+    return cl_json, cl_weights, diff
+
+
+def main(args):
+    parser = parsefn()
+    model_json, model_weights, tol = parse_inputs(parser, args)
+
+    cl_json, cl_weights, diff = convert_model(model_json, model_weights, tol=tol)
+
+    print("\n channels-last model saved to %s and %s (max output difference %.2e)" % (cl_json, cl_weights, diff))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import os
+import sys
+import json
+import argcomplete
+import argparse
+import numpy as np
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
+
+# MC samples drawn from the keras and frozen models to compare stochastic outputs
+CHECK_MC = 16
+
+# graph transforms applied after freezing (when tensorflow.tools.graph_transforms is available)
+GRAPH_TRANSFORMS = ['remove_nodes(op=Identity, op=CheckNumerics)', 'fold_constants(ignore_errors=true)',
+                    'fold_batch_norms', 'fold_old_batch_norms', 'strip_unused_nodes', 'sort_by_execution_order']
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage="%(prog)s -j [ model json ] -w [ model weights ] \n\n"
+                                           "Freeze a model to an optimized TensorFlow inference graph "
+                                           "(used by seg_hipp when present)\n\n"
+                                           "Examples: \n"
+                                           "    python -m hippmapper.deep.freeze "
+                                           "-j models/hipp_model.json -w models/hipp_model_weights.h5 \n")
+
+    required = parser.add_argument_group('required arguments')
+
+    required.add_argument('-j', '--json', type=str, metavar='', help="model architecture (json)", required=True)
+    required.add_argument('-w', '--weights', type=str, metavar='', help="model weights (h5)", required=True)
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-t', '--tol', type=float, metavar='', default=1e-4,
+                          help="max absolute difference allowed between outputs (default: %(default)s)")
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    assert os.path.exists(args.json), "%s does not exist ... please check path and rerun script" % args.json
+    assert os.path.exists(args.weights), "%s does not exist ... please check path and rerun script" % args.weights
+
+    return args.json, args.weights, args.tol
+
+
+def frozen_files(model_json):
+    """
+    Files of the frozen version of a model
+    :param model_json: model architecture (json)
+    :return: frozen graph (pb), graph info (json)
+    """
+    model_name = model_json[:-len('.json')] if model_json.endswith('.json') else model_json
+    return '%s_frozen.pb' % model_name, '%s_frozen.json' % model_name
+
+
+def optimize_graph(graph_def, input_names, output_names):
+    """
+    Optimize frozen graph for inference (constant folding, fused batch norms, unused nodes removed)
+    :param graph_def: frozen graph def
+    :param input_names: input node names
+    :param output_names: output node names (kept)
+    :return: optimized graph def
+    """
+    import tensorflow as tf
+    from tensorflow.python.framework import graph_util
+
+    graph_def = graph_util.remove_training_nodes(graph_def, protected_nodes=output_names)
+
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+        return TransformGraph(graph_def, input_names, output_names, GRAPH_TRANSFORMS)
+    except ImportError:
+        from tensorflow.python.tools import optimize_for_inference_lib
+        return optimize_for_inference_lib.optimize_for_inference(graph_def, input_names, output_names,
+                                                                 tf.float32.as_datatype_enum)
+
+
+def freeze_model(model_json, model_weights, tol=1e-4):
+    """
+    Freeze model (weights as constants, inference phase) to an optimized graph saved next to the model.
+    The deterministic tensors feeding the dropout layers are kept as outputs so MC dropout can reuse them.
+    For MC dropout models the final output is also checked: frozen samples must differ (dropout was not folded
+    away with the learning phase) and their mean must match the keras MC mean within sampling error
+    :param model_json: model architecture (json)
+    :param model_weights: model weights (h5)
+    :param tol: max absolute difference allowed between keras and frozen outputs (beyond MC sampling error)
+    :return: frozen graph (pb), graph info (json), max absolute difference
+    """
+    from keras import backend as K
+    from tensorflow.python.framework import graph_util
+    from hippmapper.deep.predict import load_old_model_json, clear_model_cache
+    from hippmapper.deep.mc_dropout import split_at_stochastic, estimate_sample_memory, STOCHASTIC_LAYERS
+    from hippmapper.deep.convert_channels_last import is_channels_last
+
+    # build in a fresh graph with the learning phase fixed to inference
+    clear_model_cache()
+    K.set_learning_phase(0)
+
+    with open(model_json, 'r') as json_file:
+        model = load_old_model_json(json_file.read())
+    model.load_weights(model_weights)
+
+    frontier = split_at_stochastic(model)
+    input_names = [tensor.op.name for tensor in model.inputs]
+    output_names = [tensor.op.name for tensor in model.outputs]
+    keep_names = output_names + [tensor.op.name for tensor in frontier if tensor.op.name not in output_names]
+
+    session = K.get_session()
+    graph_def = graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(), keep_names)
+    graph_def = optimize_graph(graph_def, input_names, keep_names)
+
+    info = dict(input=model.inputs[0].name, output=model.outputs[0].name,
+                frontier=[tensor.name for tensor in frontier], input_shape=list(K.int_shape(model.input)[1:]),
+                channels_last=is_channels_last(model), sample_memory=estimate_sample_memory(model),
+                stochastic=any(isinstance(layer, STOCHASTIC_LAYERS) for layer in model.layers))
+
+    model_pb, model_info = frozen_files(model_json)
+    with open(model_pb, 'wb') as pb_file:
+        pb_file.write(graph_def.SerializeToString())
+    with open(model_info, 'w') as json_file:
+        json.dump(info, json_file, indent=2)
+
+    # compare deterministic outputs (activations before dropout for MC dropout models)
+    test_data = np.random.randn(*([1] + info['input_shape'])).astype(np.float32)
+    check_tensors = frontier if info['stochastic'] else model.outputs
+    expected = K.function(model.inputs, check_tensors)([test_data])
+
+    frozen = FrozenModel(model_pb, model_info)
+    check_names = info['frontier'] if info['stochastic'] else [info['output']]
+    frozen_out = frozen.function([info['input']], check_names)([test_data, 0])
+
+    diff = max([float(np.max(np.abs(exp - out))) for exp, out in zip(expected, frozen_out)] + [0.])
+
+    error = None
+    if diff > tol:
+        error = "frozen model output differs by %s (tolerance %s)" % (diff, tol)
+
+    elif info['stochastic']:
+        # MC output: samples of the same input must differ, means must agree within sampling error
+        mc_data = np.repeat(test_data, CHECK_MC, axis=0)
+        keras_samples = K.function(model.inputs, model.outputs)([mc_data])[0]
+        frozen_samples = frozen.predict(mc_data)
+
+        if not np.any(frozen_samples[0] != frozen_samples[1]):
+            error = "frozen MC dropout samples are identical, dropout depends on the learning phase and was " \
+                    "removed when freezing (use the keras model)"
+        else:
+            std_err = np.sqrt((keras_samples.var(axis=0) + frozen_samples.var(axis=0)) / CHECK_MC)
+            mc_diff = np.abs(frozen_samples.mean(axis=0) - keras_samples.mean(axis=0)) - 6 * std_err
+            diff = max(diff, float(np.max(mc_diff)))
+            if diff > tol:
+                error = "frozen MC mean differs from the keras MC mean by %s beyond sampling error " \
+                        "(tolerance %s)" % (diff, tol)
+
+    frozen.close()
+
+    # back to a fresh graph (also resets the learning phase)
+    clear_model_cache()
+
+    if error is not None:
+        os.remove(model_pb)
+        os.remove(model_info)
+        raise ValueError(error)
+
+    return model_pb, model_info, diff
+
+
+class FrozenModel(object):
+    """
+    Frozen inference graph with the parts of the keras model interface used for prediction
+    """
+
+    def __init__(self, model_pb, model_info):
+        """
+        :param model_pb: frozen graph (from freeze_model)
+        :param model_info: graph info (json)
+        """
+        import tensorflow as tf
+        from hippmapper.deep.session import get_session_config
+
+        with open(model_info, 'r') as json_file:
+            info = json.load(json_file)
+
+        self.input_name = info['input']
+        self.output_name = info['output']
+        self.frontier_names = info['frontier']
+        self.input_shape = tuple([None] + info['input_shape'])
+        self.channels_last = info['channels_last']
+        self.sample_memory = info['sample_memory']
+
+        graph_def = tf.GraphDef()
+        with open(model_pb, 'rb') as pb_file:
+            graph_def.ParseFromString(pb_file.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+
+        self.session = tf.Session(graph=self.graph, config=get_session_config())
+
+    def function(self, inputs, outputs):
+        """
+        Callable running the graph, with the calling convention of keras backend functions
+        (list of input values followed by the learning phase, which is fixed in the frozen graph)
+        :param inputs: input tensor names
+        :param outputs: output tensor names
+        :return: function returning list of outputs
+        """
+        def run(values):
+            return self.session.run(outputs, feed_dict=dict(zip(inputs, values[:len(inputs)])))
+
+        return run
+
+    def predict(self, data, batch_size=None):
+        """
+        Predict in batches
+        :param data: input array
+        :param batch_size: samples per run (all if None)
+        :return: prediction
+        """
+        batch_size = batch_size or data.shape[0]
+        return np.concatenate([self.session.run(self.output_name,
+                                                feed_dict={self.input_name: data[start:start + batch_size]})
+                               for start in range(0, data.shape[0], batch_size)])
+
+    def close(self):
+        self.session.close()
+
+
+def main(args):
+    parser = parsefn()
+    model_json, model_weights, tol = parse_inputs(parser, args)
+
+    model_pb, model_info, diff = freeze_model(model_json, model_weights, tol=tol)
+
+    print("\n frozen model saved to %s and %s (max output difference %.2e)" % (model_pb, model_info, diff))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
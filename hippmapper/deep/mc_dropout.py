@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+
+# coding: utf-8
+
+import os
+import time
+import numpy as np
+
+from keras import backend as K
+from keras.layers import Dropout, GaussianDropout, GaussianNoise, AlphaDropout
+from hippmapper.utils.sys_utils import available_memory
+from hippmapper.deep.convert_channels_last import is_channels_last, to_channels_last, to_channels_first
+from hippmapper.deep.freeze import FrozenModel
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
+
+STOCHASTIC_LAYERS = (Dropout, GaussianDropout, GaussianNoise, AlphaDropout)
+
+
+def _to_list(tensors):
+    return tensors if isinstance(tensors, list) else [tensors]
+
+
+def split_at_stochastic(model):
+    """
+    Find the deterministic tensors feeding the stochastic part of the model
+    (layers from the first dropout/noise layer onwards, including skip connections into them)
+    :param model: keras model
+    :return: list of frontier tensors (empty if model has no stochastic layers or they act on the input)
+    """
+    stochastic = set()
+    frontier = []
+    frontier_set = set()
+
+    # model.layers are in topological order
+    for layer in model.layers:
+        inputs = _to_list(layer.input)
+        if isinstance(layer, STOCHASTIC_LAYERS) or any(tensor in stochastic for tensor in inputs):
+            for tensor in inputs:
+                if tensor not in stochastic and tensor not in frontier_set:
+                    frontier.append(tensor)
+                    frontier_set.add(tensor)
+            stochastic.update(_to_list(layer.output))
+
+    if any(tensor in frontier_set for tensor in _to_list(model.input)):
+        return []
+
+    return frontier
+
+
+def estimate_sample_memory(model, dtype_size=4):
+    """
+    Upper bound of memory needed for the forward pass of one sample (all layer activations)
+    :param model: keras model
+    :param dtype_size: bytes per element
+    :return: memory in bytes
+    """
+    if isinstance(model, FrozenModel):
+        # estimated when the graph was frozen
+        return model.sample_memory
+
+    n_elements = 0
+    for layer in model.layers:
+        outputs = layer.output if isinstance(layer.output, list) else [layer.output]
+        for output in outputs:
+            n_elements += int(np.prod([dim for dim in K.int_shape(output)[1:] if dim is not None]))
+
+    return n_elements * dtype_size
+
+
+def auto_batch_size(model, num_mc, memory_fraction=0.5):
+    """
+    Largest MC batch size that fits in a fraction of the available memory
+    :param model: keras model
+    :param num_mc: number of Monte Carlo samples
+    :param memory_fraction: fraction of available memory to use
+    :return: batch size
+    """
+    avail = available_memory()
+    if avail is None:
+        return 1
+
+    batch_size = int(avail * memory_fraction / estimate_sample_memory(model))
+
+    return int(np.clip(batch_size, 1, num_mc))
+
+
+def _entropy(prob, eps=1e-7):
+    # binary entropy for single-channel (sigmoid) outputs, categorical otherwise (channel axis = -4)
+    prob = np.clip(prob, eps, 1. - eps)
+    if prob.shape[-4] == 1:
+        return -(prob * np.log(prob) + (1. - prob) * np.log(1. - prob))[..., 0, :, :, :]
+    return -np.sum(prob * np.log(prob), axis=-4)
+
+
+class MCStatistics(object):
+    """
+    Streaming statistics of MC samples (Welford / Chan et al. batch updates),
+    memory does not grow with the number of samples
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self._m2 = None
+        self._entropy_sum = None
+
+    def update(self, batch):
+        """
+        Fold a batch of samples into the running statistics
+        :param batch: predictions (n, channels, x, y, z)
+        """
+        n_batch = batch.shape[0]
+        batch_mean = batch.mean(axis=0, dtype=np.float64)
+        batch_m2 = np.square(batch - batch_mean).sum(axis=0)
+        batch_entropy = _entropy(batch).sum(axis=0, dtype=np.float64)
+
+        if self.count == 0:
+            self.mean, self._m2, self._entropy_sum = batch_mean, batch_m2, batch_entropy
+        else:
+            count = self.count + n_batch
+            delta = batch_mean - self.mean
+            self.mean += delta * (n_batch / count)
+            self._m2 += batch_m2 + np.square(delta) * (self.count * n_batch / count)
+            self._entropy_sum += batch_entropy
+
+        self.count += n_batch
+
+    @property
+    def variance(self):
+        """voxel-wise variance of samples (channels, x, y, z)"""
+        return self._m2 / self.count
+
+    @property
+    def entropy(self):
+        """predictive entropy: entropy of the mean prediction (x, y, z)"""
+        return _entropy(self.mean)
+
+    @property
+    def mutual_info(self):
+        """mutual information: predictive entropy minus expected entropy of samples (x, y, z)"""
+        return np.clip(self.entropy - self._entropy_sum / self.count, 0, None)
+
+
+def mc_converged(prev_mean, mean, criterion='mask', tol=0.005, thresh=0.5):
+    """
+    Check if running MC mean stabilized
+    :param prev_mean: running mean before last batch
+    :param mean: running mean after last batch
+    :param criterion: 'mask' (fraction of voxels in thresholded masks that changed label)
+     or 'mean' (max voxel-wise change of running mean)
+    :param tol: tolerance
+    :param thresh: threshold of mask criterion
+    :return: True if change is below tolerance
+    """
+    if criterion == 'mask':
+        prev_mask = prev_mean > thresh
+        mask = mean > thresh
+        n_union = np.count_nonzero(prev_mask | mask)
+        if n_union == 0:
+            return True
+        return np.count_nonzero(prev_mask != mask) / n_union < tol
+    elif criterion == 'mean':
+        return np.max(np.abs(mean - prev_mean)) < tol
+    else:
+        raise ValueError("'criterion' must be either 'mask' or 'mean'. '{}' is not recognized".format(criterion))
+
+
+class MCDropoutEngine(object):
+    """
+    Monte Carlo dropout inference that stacks samples into batched forward passes
+    """
+
+    def __init__(self, model, batch_size=None, memory_fraction=0.5, force_dropout=False, cache_activations=True):
+        """
+        :param model: keras model with dropout layers
+        :param batch_size: samples per forward pass (auto-sized from available memory if None)
+        :param memory_fraction: fraction of available memory used when auto-sizing the batch
+        :param force_dropout: run in training phase so dropout is active even if the model does not force it
+        :param cache_activations: evaluate the deterministic layers before the first dropout layer once
+         and only replay the stochastic part for each sample
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self.memory_fraction = memory_fraction
+        self.force_dropout = force_dropout
+        self.batch_times = []
+
+        self._learning_phase = 1 if force_dropout else 0
+        # channels-last models get transposed inputs and outputs, samples stay channels-first
+        self._channels_last = is_channels_last(model)
+
+        if isinstance(model, FrozenModel):
+            # frozen graph: intermediate tensors can be fed directly, learning phase is fixed to inference
+            if force_dropout:
+                raise ValueError("force_dropout needs the keras model, frozen graphs are fixed to inference phase")
+            frontier = model.frontier_names if cache_activations else []
+            self._prefix_fn = model.function([model.input_name], frontier) if frontier else None
+            self._suffix_fn = model.function(frontier, [model.output_name]) if frontier else None
+            self._predict_fn = None
+            return
+
+        frontier = split_at_stochastic(model) if cache_activations else []
+
+        if frontier:
+            # deterministic prefix and stochastic suffix (intermediate tensors are fed directly)
+            self._prefix_fn = K.function(_to_list(model.input) + [K.learning_phase()], frontier)
+            self._suffix_fn = K.function(frontier + [K.learning_phase()], [model.output])
+        else:
+            self._prefix_fn = None
+            self._suffix_fn = None
+
+        if force_dropout:
+            self._predict_fn = K.function(_to_list(model.input) + [K.learning_phase()], [model.output])
+        else:
+            self._predict_fn = None
+
+    def _to_model(self, data):
+        return to_channels_last(data) if self._channels_last else data
+
+    def _from_model(self, prediction):
+        return to_channels_first(prediction) if self._channels_last else prediction
+
+    def _forward(self, batch):
+        batch = self._to_model(batch)
+        if self._predict_fn is not None:
+            return self._from_model(self._predict_fn([batch, self._learning_phase])[0])
+        return self._from_model(self.model.predict(batch, batch_size=batch.shape[0]))
+
+    def _forward_suffix(self, activations, n_batch):
+        batch = [np.repeat(activation, n_batch, axis=0) for activation in activations]
+        return self._from_model(self._suffix_fn(batch + [self._learning_phase])[0])
+
+    def sample_batches(self, test_data, num_mc, max_batch=None):
+        """
+        Generate MC samples in batches
+        :param test_data: input of shape (1, channels, x, y, z)
+        :param num_mc: number of Monte Carlo samples
+        :param max_batch: upper bound of batch size
+        :return: generator of prediction batches (n, channels, x, y, z)
+        """
+        batch_size = self.batch_size
+        if batch_size is None:
+            batch_size = auto_batch_size(self.model, num_mc, self.memory_fraction)
+        if max_batch is not None:
+            batch_size = max(1, min(batch_size, max_batch))
+
+        self.batch_times = []
+        n_done = 0
+
+        if self._prefix_fn is not None:
+            activations = self._prefix_fn([self._to_model(test_data), self._learning_phase])
+
+        while n_done < num_mc:
+            n_batch = min(batch_size, num_mc - n_done)
+
+            start_time = time.time()
+            if self._prefix_fn is not None:
+                prediction = self._forward_suffix(activations, n_batch)
+            else:
+                prediction = self._forward(np.repeat(test_data, n_batch, axis=0))
+            self.batch_times.append(time.time() - start_time)
+
+            n_done += n_batch
+            yield prediction
+
+    def _forward_multi(self, inputs, counts):
+        # inputs: per-subject cached activations (list of arrays) or input volumes, counts: samples per subject
+        if self._prefix_fn is not None:
+            batch = [np.concatenate([np.repeat(subj_inputs[tensor_id], count, axis=0)
+                                     for subj_inputs, count in zip(inputs, counts)])
+                     for tensor_id in range(len(inputs[0]))]
+            return self._from_model(self._suffix_fn(batch + [self._learning_phase])[0])
+
+        return self._forward(np.concatenate([np.repeat(subj_input, count, axis=0)
+                                             for subj_input, count in zip(inputs, counts)]))
+
+    @staticmethod
+    def _next_check(count, first_check, min_mc, check_every):
+        # samples to draw until the next convergence check of a subject with count samples
+        if count < first_check:
+            return first_check - count
+        if count < min_mc:
+            return min_mc - count
+        return check_every
+
+    def predict_stats_multi(self, test_data_list, num_mc, adaptive=False, min_mc=10, tol=0.005, criterion='mask',
+                            thresh=0.5):
+        """
+        Streaming statistics over MC samples of several subjects, forward passes stack
+        (subjects x samples) and results are scattered back per subject
+        :param test_data_list: inputs of shape (1, channels, x, y, z), one per subject
+        :param num_mc: number of Monte Carlo samples per subject (maximum if adaptive)
+        :param adaptive: stop drawing samples of a subject once its running mean converged
+        :param min_mc: minimum number of samples if adaptive (earliest stop)
+        :param tol: convergence tolerance (see mc_converged)
+        :param criterion: convergence criterion, 'mask' or 'mean' (see mc_converged)
+        :param thresh: threshold of mask criterion
+        :return: list of MCStatistics (one per subject)
+        """
+        n_subj = len(test_data_list)
+        stats = [MCStatistics() for _ in range(n_subj)]
+
+        batch_size = self.batch_size
+        if batch_size is None:
+            batch_size = auto_batch_size(self.model, num_mc * n_subj, self.memory_fraction)
+        if adaptive:
+            # convergence is first checked at min_mc samples (against the running mean a chunk earlier),
+            # then at least every check_every samples
+            check_every = max(1, min_mc // 2)
+            first_check = max(1, min_mc - check_every)
+        else:
+            check_every, first_check, min_mc = num_mc, 0, 0
+
+        if self._prefix_fn is not None:
+            # deterministic part of all subjects in one pass
+            activations = self._prefix_fn([self._to_model(np.concatenate(test_data_list)), self._learning_phase])
+            inputs = [[activation[subj_id:subj_id + 1] for activation in activations] for subj_id in range(n_subj)]
+        else:
+            inputs = test_data_list
+
+        self.batch_times = []
+        remaining = [num_mc] * n_subj
+        active = list(range(n_subj))
+
+        while active:
+            # share the batch between subjects still sampling
+            share = max(1, batch_size // len(active))
+            batch_subjs = []
+            counts = []
+            for subj_id in active:
+                if sum(counts) >= batch_size:
+                    break
+                count = min(share, self._next_check(stats[subj_id].count, first_check, min_mc, check_every),
+                            remaining[subj_id], batch_size - sum(counts))
+                batch_subjs.append(subj_id)
+                counts.append(count)
+
+            start_time = time.time()
+            prediction = self._forward_multi([inputs[subj_id] for subj_id in batch_subjs], counts)
+            self.batch_times.append(time.time() - start_time)
+
+            offsets = np.cumsum([0] + counts)
+            for subj_id, start, stop in zip(batch_subjs, offsets[:-1], offsets[1:]):
+                subj_stats = stats[subj_id]
+                prev_mean = subj_stats.mean.copy() if subj_stats.count > 0 else None
+                subj_stats.update(prediction[start:stop])
+                remaining[subj_id] -= stop - start
+
+                if remaining[subj_id] == 0 or \
+                        (adaptive and prev_mean is not None and subj_stats.count >= min_mc and
+                         mc_converged(prev_mean, subj_stats.mean, criterion=criterion, tol=tol, thresh=thresh)):
+                    active.remove(subj_id)
+
+            # subjects that were left out of this batch go first next time
+            active = [subj_id for subj_id in active if subj_id not in batch_subjs] + \
+                     [subj_id for subj_id in active if subj_id in batch_subjs]
+
+        return stats
+
+    def predict_stats(self, test_data, num_mc, adaptive=False, min_mc=10, tol=0.005, criterion='mask',
+                      thresh=0.5):
+        """
+        Streaming statistics over MC samples
+        :param test_data: input of shape (1, channels, x, y, z)
+        :param num_mc: number of Monte Carlo samples (maximum if adaptive)
+        :param adaptive: stop drawing samples once the running mean converged
+        :param min_mc: minimum number of samples if adaptive
+        :param tol: convergence tolerance (see mc_converged)
+        :param criterion: convergence criterion, 'mask' or 'mean' (see mc_converged)
+        :param thresh: threshold of mask criterion
+        :return: MCStatistics (mean, variance, entropy, mutual information, count of samples used)
+        """
+        return self.predict_stats_multi([test_data], num_mc, adaptive=adaptive, min_mc=min_mc, tol=tol,
+                                        criterion=criterion, thresh=thresh)[0]
+
+    def predict(self, test_data, num_mc):
+        """
+        Mean prediction over MC samples
+        :param test_data: input of shape (1, channels, x, y, z)
+        :param num_mc: number of Monte Carlo samples
+        :return: mean prediction (channels, x, y, z)
+        """
+        return self.predict_stats(test_data, num_mc).mean
@@ -3,11 +3,18 @@
 # coding: utf-8
 
 import os
+import threading
 import nibabel as nib
 import numpy as np
 
+from keras import backend as K
 from keras.models import model_from_json
 from keras_contrib.layers import InstanceNormalization
+from hippmapper.deep.mc_dropout import MCDropoutEngine
+from hippmapper.deep.freeze import FrozenModel, frozen_files
+from hippmapper.deep.quantize import QuantizedModel, quantized_files, QUANT_MODES
+from hippmapper.deep.convert_channels_last import (channels_last_files, is_channels_last, to_channels_last,
+                                                   to_channels_first)
 from hippmapper.deep.metrics import (dice_coefficient, dice_coefficient_loss, dice_coef, dice_coef_loss,
                                       weighted_dice_coefficient_loss, weighted_dice_coefficient)
 import warnings
@@ -17,6 +24,19 @@ warnings.simplefilter("ignore", FutureWarning)
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
 
+# process-wide cache of built models (and their MC engines), keyed by model files and their modification stamps
+_MODEL_CACHE = {}
+_MODEL_CACHE_LOCK = threading.Lock()
+
+# use channels-last versions of models (from convert_channels_last) when they exist
+_PREFER_CHANNELS_LAST = [True]
+# use frozen graphs of models (from freeze) when they exist
+_PREFER_FROZEN = [True]
+# use reduced-precision versions of models (from quantize) of this mode when they exist (None: float32)
+_QUANT_MODE = [None]
+# quantized versions found missing (warned once per process)
+_QUANT_MISSING = set()
+
 
 def load_old_model_json(model_json):
     print("\n loading pre-trained model")
@@ -41,6 +61,184 @@ def load_old_model_json(model_json):
             raise error
 
 
+def _file_stamp(in_file):
+    in_file = os.path.abspath(in_file)
+    stat = os.stat(in_file)
+    return in_file, stat.st_mtime_ns, stat.st_size
+
+
+def model_cache_key(model_json, model_weights):
+    """
+    Key identifying a built model
+    :param model_json: model architecture (json)
+    :param model_weights: model weights (h5)
+    :return: (json path, mtime, size, weights path, mtime, size)
+    """
+    return _file_stamp(model_json) + _file_stamp(model_weights)
+
+
+def prefer_channels_last(prefer=True):
+    """
+    Set whether channels-last versions of models are used when available (inputs and outputs stay channels-first)
+    :param prefer: use channels-last models
+    """
+    _PREFER_CHANNELS_LAST[0] = prefer
+
+
+def prefer_frozen(prefer=True):
+    """
+    Set whether frozen inference graphs of models are used when available
+    :param prefer: use frozen graphs
+    """
+    _PREFER_FROZEN[0] = prefer
+
+
+def use_quantized(mode=None):
+    """
+    Set reduced-precision mode of models, used for models that were quantized in this mode
+    :param mode: float16, int8 or None (float32)
+    """
+    _QUANT_MODE[0] = mode
+
+
+def resolve_model_files(model_json, model_weights):
+    """
+    Model files to load: channels-last version if it exists (and is preferred), else the given files
+    :param model_json: model architecture (json)
+    :param model_weights: model weights (h5)
+    :return: model json, model weights
+    """
+    if _PREFER_CHANNELS_LAST[0]:
+        cl_json, cl_weights = channels_last_files(model_json, model_weights)
+        if os.path.exists(cl_json) and os.path.exists(cl_weights):
+            return cl_json, cl_weights
+
+    return model_json, model_weights
+
+
+def select_model_files(model_json, model_weights):
+    """
+    Version of a model to build: reduced-precision (if a quantized mode is set), frozen graph or keras model,
+    of the channels-last model if available
+    :param model_json: model architecture (json)
+    :param model_weights: model weights (h5)
+    :return: kind ('quantized', 'frozen' or 'keras'), model files of this kind
+    """
+    model_json, model_weights = resolve_model_files(model_json, model_weights)
+
+    model_pb, model_info = frozen_files(model_json)
+    quant_model, quant_info = quantized_files(model_json, _QUANT_MODE[0])
+
+    if _QUANT_MODE[0] is not None:
+        if os.path.exists(quant_model) and os.path.exists(quant_info):
+            return 'quantized', (quant_model, quant_info)
+        if quant_model not in _QUANT_MISSING:
+            _QUANT_MISSING.add(quant_model)
+            print("\n warning: %s version of %s not found (%s), running it in float32 ... "
+                  "create it with hippmapper.deep.quantize" % (_QUANT_MODE[0], model_json, quant_model))
+    if _PREFER_FROZEN[0] and os.path.exists(model_pb) and os.path.exists(model_info):
+        return 'frozen', (model_pb, model_info)
+
+    return 'keras', (model_json, model_weights)
+
+
+def load_model(model_json, model_weights):
+    """
+    Build model from json + weights once per process and reuse it on later calls
+    (rebuilt if either file changed on disk). The channels-last version of the model is used if available,
+    then its reduced-precision version (if a quantized mode is set) or its frozen inference graph if exported
+    :param model_json: model architecture (json)
+    :param model_weights: model weights (h5)
+    :return: keras model (or FrozenModel / QuantizedModel)
+    """
+    kind, model_files = select_model_files(model_json, model_weights)
+    key = model_cache_key(*model_files)
+
+    with _MODEL_CACHE_LOCK:
+        model = _MODEL_CACHE.get(key)
+
+        if model is None:
+            # drop stale entries of the same model files (and their MC engines)
+            for old_key in [k for k in _MODEL_CACHE if k[0] == key[0] and k[3] == key[3]]:
+                del _MODEL_CACHE[old_key]
+
+            if kind == 'quantized':
+                model = QuantizedModel(*model_files)
+            elif kind == 'frozen':
+                model = FrozenModel(*model_files)
+            else:
+                with open(model_files[0], 'r') as json_file:
+                    loaded_model_json = json_file.read()
+                model = load_old_model_json(loaded_model_json)
+                model.load_weights(model_files[1])
+                # build predict function now so model can be shared between threads
+                model._make_predict_function()
+
+            _MODEL_CACHE[key] = model
+
+    return model
+
+
+def load_mc_engine(model_json, model_weights, batch_size=None):
+    """
+    MC Dropout engine of a model, built once per cached model so its backend functions are not added
+    to the graph again on every call (cached under the model key, evicted with the model)
+    :param model_json: model architecture (json)
+    :param model_weights: model weights (h5)
+    :param batch_size: samples per forward pass (auto-sized from available memory if None)
+    :return: MCDropoutEngine
+    """
+    model = load_model(model_json, model_weights)
+    key = model_cache_key(*select_model_files(model_json, model_weights)[1]) + ('mc_engine',)
+
+    with _MODEL_CACHE_LOCK:
+        engine = _MODEL_CACHE.get(key)
+        if engine is None or engine.model is not model:
+            engine = MCDropoutEngine(model)
+            _MODEL_CACHE[key] = engine
+
+    engine.batch_size = batch_size
+
+    return engine
+
+
+def evict_model(model_json, model_weights=None):
+    """
+    Remove cached model(s) built from the given files (or their channels-last / frozen / quantized versions)
+    and their MC engines
+    :param model_json: model architecture (json)
+    :param model_weights: model weights (h5), all weights of model_json if None
+    :return: number of evicted models
+    """
+    cl_json, cl_weights = channels_last_files(model_json, model_weights or '')
+    variants = [frozen_files(json) for json in (model_json, cl_json)] + \
+               [quantized_files(json, mode) for json in (model_json, cl_json) for mode in QUANT_MODES]
+    json_paths = [os.path.abspath(path) for path in [model_json, cl_json] + [files[0] for files in variants]]
+    weights_paths = None
+    if model_weights is not None:
+        weights_paths = [os.path.abspath(path) for path in [model_weights, cl_weights] +
+                         [files[1] for files in variants]]
+
+    with _MODEL_CACHE_LOCK:
+        keys = [k for k in _MODEL_CACHE if k[0] in json_paths and (weights_paths is None or k[3] in weights_paths)]
+        for key in keys:
+            del _MODEL_CACHE[key]
+
+    return len([key for key in keys if key[-1] != 'mc_engine'])
+
+
+def clear_model_cache():
+    """
+    Remove all cached models (and MC engines) and release the keras session
+    """
+    with _MODEL_CACHE_LOCK:
+        for model in _MODEL_CACHE.values():
+            if isinstance(model, FrozenModel):
+                model.close()
+        _MODEL_CACHE.clear()
+        K.clear_session()
+
+
 def get_prediction_labels(prediction, threshold=0.5, labels=None):
     n_samples = prediction.shape[0]
     label_arrays = []
@@ -83,14 +281,81 @@ def multi_class_prediction(prediction, affine):
 
 def run_test_case(test_data, model_json, model_weights, affine,
                   output_label_map=False, threshold=0.5, labels=None):
-    json_file = open(model_json, 'r')
-    loaded_model_json = json_file.read()
-    json_file.close()
-    model = load_old_model_json(loaded_model_json)
+    return run_test_cases([test_data], model_json, model_weights, [affine], output_label_map=output_label_map,
+                          threshold=threshold, labels=labels)[0]
+
+
+def run_test_cases(test_data_list, model_json, model_weights, affines, batch_size=None,
+                   output_label_map=False, threshold=0.5, labels=None):
+    """
+    Predict several cases with batched forward passes
+    :param test_data_list: inputs of shape (1, channels, x, y, z), one per case
+    :param model_json: model architecture (json)
+    :param model_weights: model weights (h5)
+    :param affines: affines of output images
+    :param batch_size: cases per forward pass (all cases if None)
+    :return: prediction images
+    """
+    model = load_model(model_json, model_weights)
+
+    test_data = np.concatenate(test_data_list)
+    if is_channels_last(model):
+        prediction = to_channels_first(model.predict(to_channels_last(test_data),
+                                                     batch_size=batch_size or test_data.shape[0]))
+    else:
+        prediction = model.predict(test_data, batch_size=batch_size or test_data.shape[0])
+
+    return [prediction_to_image(prediction[case_id:case_id + 1], affine, label_map=output_label_map,
+                                threshold=threshold, labels=labels)
+            for case_id, affine in enumerate(affines)]
+
+
+def run_mc_test_case(test_data, model_json, model_weights, affine, num_mc, batch_size=None,
+                     adaptive=False, min_mc=10, tol=0.005, criterion='mask', mc_thresh=0.5,
+                     output_label_map=False, threshold=0.5, labels=None):
+    """
+    Monte Carlo dropout prediction with samples stacked into batched forward passes
+    :param test_data: input of shape (1, channels, x, y, z)
+    :param model_json: model architecture (json)
+    :param model_weights: model weights (h5)
+    :param affine: affine of output image
+    :param num_mc: number of Monte Carlo samples (maximum if adaptive)
+    :param batch_size: samples per forward pass (auto-sized from available memory if None)
+    :param adaptive: stop drawing samples once the mean prediction converged
+    :param min_mc: minimum number of samples if adaptive
+    :param tol: convergence tolerance
+    :param criterion: convergence criterion, 'mask' (changed voxels in thresholded mask) or 'mean' (max change)
+    :param mc_thresh: threshold of mask criterion
+    :return: mean prediction image, uncertainty images (variance, entropy, mutual_info),
+     MC info (num_samples, batch_times)
+    """
+    return run_mc_test_cases([test_data], model_json, model_weights, [affine], num_mc, batch_size=batch_size,
+                             adaptive=adaptive, min_mc=min_mc, tol=tol, criterion=criterion, mc_thresh=mc_thresh,
+                             output_label_map=output_label_map, threshold=threshold, labels=labels)[0]
+
 
-    model.load_weights(model_weights)
+def run_mc_test_cases(test_data_list, model_json, model_weights, affines, num_mc, batch_size=None,
+                      adaptive=False, min_mc=10, tol=0.005, criterion='mask', mc_thresh=0.5,
+                      output_label_map=False, threshold=0.5, labels=None):
+    """
+    Monte Carlo dropout prediction of several cases, forward passes stack (cases x samples)
+    :param test_data_list: inputs of shape (1, channels, x, y, z), one per case
+    :param affines: affines of output images
+    :param batch_size: samples (of all cases) per forward pass (auto-sized from available memory if None)
+    :return: list of (mean prediction image, uncertainty images, MC info) per case (see run_mc_test_case)
+    """
+    engine = load_mc_engine(model_json, model_weights, batch_size=batch_size)
+    case_stats = engine.predict_stats_multi(test_data_list, num_mc, adaptive=adaptive, min_mc=min_mc, tol=tol,
+                                            criterion=criterion, thresh=mc_thresh)
 
-    prediction = model.predict(test_data)
+    results = []
+    for stats, affine in zip(case_stats, affines):
+        prediction = prediction_to_image(stats.mean[np.newaxis], affine, label_map=output_label_map,
+                                         threshold=threshold, labels=labels)
+        uncertainty = {'variance': prediction_to_image(stats.variance[np.newaxis], affine),
+                       'entropy': nib.Nifti1Image(stats.entropy, affine),
+                       'mutual_info': nib.Nifti1Image(stats.mutual_info, affine)}
+        mc_info = {'num_samples': stats.count, 'batch_times': engine.batch_times}
+        results.append((prediction, uncertainty, mc_info))
 
-    return prediction_to_image(prediction, affine, label_map=output_label_map, threshold=threshold,
-                               labels=labels)
+    return results
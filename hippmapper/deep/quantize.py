@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import threading
+import argcomplete
+import argparse
+import numpy as np
+import nibabel as nib
+
+from hippmapper.deep.freeze import FrozenModel, frozen_files, freeze_model, CHECK_MC
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
+
+QUANT_MODES = ('float16', 'int8')
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage="%(prog)s -j [ model json ] -w [ model weights ] -m [ mode ] \n\n"
+                                           "Create a reduced-precision (TensorFlow Lite) variant of a model "
+                                           "and compare it to the float32 model\n\n"
+                                           "Examples: \n"
+                                           "    python -m hippmapper.deep.quantize -j models/hipp_model.json "
+                                           "-w models/hipp_model_weights.h5 -m int8 "
+                                           "-v 'val/*/pred_process/*_thresholded_resampled.nii.gz' \n")
+
+    required = parser.add_argument_group('required arguments')
+
+    required.add_argument('-j', '--json', type=str, metavar='', help="model architecture (json)", required=True)
+    required.add_argument('-w', '--weights', type=str, metavar='', help="model weights (h5)", required=True)
+    required.add_argument('-m', '--mode', type=str, metavar='', choices=QUANT_MODES, required=True,
+                          help="float16 (weight-only) or int8 (dynamic range)")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-t', '--tol', type=float, metavar='', default=0.05,
+                          help="max absolute difference allowed between float32 and reduced-precision outputs, "
+                               "beyond MC sampling error (default: %(default)s)")
+    optional.add_argument('-v', '--val', type=str, metavar='',
+                          help="validation inputs for the accuracy report: glob of model input images "
+                               "(saved by seg_hipp --save_interm: *_thresholded_resampled for stage 1, "
+                               "*_trimmed_resampled for the zoom model)")
+    optional.add_argument('-n', '--num_mc', type=int, metavar='', default=30,
+                          help="MC Dropout samples for models with dropout (default: %(default)s)")
+    optional.add_argument('-th', '--thresh', type=float, metavar='', default=0.5,
+                          help="threshold of predictions for Dice (default: %(default)s)")
+    optional.add_argument('-o', '--out', type=str, metavar='', help="accuracy report (csv)")
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    assert os.path.exists(args.json), "%s does not exist ... please check path and rerun script" % args.json
+    assert os.path.exists(args.weights), "%s does not exist ... please check path and rerun script" % args.weights
+
+    val = sorted(glob.glob(args.val)) if args.val else []
+    if args.val:
+        assert val, "no validation inputs found: %s" % args.val
+
+    return args.json, args.weights, args.mode, args.tol, val, args.num_mc, args.thresh, args.out
+
+
+def quantized_files(model_json, mode):
+    """
+    Files of the reduced-precision version of a model
+    :param model_json: model architecture (json)
+    :param mode: float16 or int8
+    :return: tflite model, model info (json)
+    """
+    model_name = model_json[:-len('.json')] if model_json.endswith('.json') else model_json
+    return '%s_%s.tflite' % (model_name, mode), '%s_%s.json' % (model_name, mode)
+
+
+def quantize_model(model_json, model_weights, mode, tol=0.05):
+    """
+    Convert model (through its frozen graph) to TensorFlow Lite with float16 weights or int8 dynamic-range
+    quantization (int8 weights, activations quantized on the fly), saved next to the model.
+    Ops without a TensorFlow Lite kernel (e.g. Conv3D in older versions) run as TensorFlow ops.
+    The output is checked against the keras model: for MC dropout models the samples must differ
+    and their mean must match the keras MC mean within sampling error
+    :param model_json: model architecture (json)
+    :param model_weights: model weights (h5)
+    :param mode: float16 or int8
+    :param tol: max absolute difference allowed between keras and tflite outputs (beyond MC sampling error)
+    :return: tflite model, model info (json)
+    """
+    import tensorflow as tf
+
+    assert mode in QUANT_MODES, "mode must be one of %s" % (QUANT_MODES,)
+
+    model_pb, model_info = frozen_files(model_json)
+    if not (os.path.exists(model_pb) and os.path.exists(model_info)):
+        freeze_model(model_json, model_weights)
+
+    with open(model_info, 'r') as json_file:
+        info = json.load(json_file)
+
+    converter = tf.lite.TFLiteConverter.from_frozen_graph(model_pb, [info['input'].split(':')[0]],
+                                                          [info['output'].split(':')[0]],
+                                                          input_shapes={info['input'].split(':')[0]:
+                                                                        [1] + info['input_shape']})
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    converter.target_spec.supported_ops = set([tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS])
+
+    quant_model, quant_info = quantized_files(model_json, mode)
+    with open(quant_model, 'wb') as tflite_file:
+        tflite_file.write(converter.convert())
+
+    # no intermediate tensors to feed in the interpreter
+    info.update(frontier=[], mode=mode)
+    with open(quant_info, 'w') as json_file:
+        json.dump(info, json_file, indent=2)
+
+    error = check_quantized(model_json, model_weights, quant_model, quant_info, tol)
+    if error is not None:
+        os.remove(quant_model)
+        os.remove(quant_info)
+        raise ValueError(error)
+
+    return quant_model, quant_info
+
+
+def check_quantized(model_json, model_weights, quant_model, quant_info, tol):
+    """
+    Compare the output of a reduced-precision model to the keras model (MC samples for MC dropout models)
+    :param model_json: model architecture (json)
+    :param model_weights: model weights (h5)
+    :param quant_model: tflite model
+    :param quant_info: model info (json)
+    :param tol: max absolute difference allowed (beyond MC sampling error)
+    :return: error message (None if the outputs agree)
+    """
+    from keras import backend as K
+    from hippmapper.deep.predict import load_old_model_json, clear_model_cache
+    from hippmapper.deep.mc_dropout import STOCHASTIC_LAYERS
+
+    # keras model in a fresh graph with the learning phase fixed to inference (as when freezing)
+    clear_model_cache()
+    K.set_learning_phase(0)
+
+    with open(model_json, 'r') as json_file:
+        model = load_old_model_json(json_file.read())
+    model.load_weights(model_weights)
+
+    quant = QuantizedModel(quant_model, quant_info)
+    stochastic = any(isinstance(layer, STOCHASTIC_LAYERS) for layer in model.layers)
+
+    test_data = np.random.randn(*([1] + list(quant.input_shape[1:]))).astype(np.float32)
+    check_data = np.repeat(test_data, CHECK_MC, axis=0) if stochastic else test_data
+    keras_samples = K.function(model.inputs, model.outputs)([check_data])[0]
+    quant_samples = quant.predict(check_data, batch_size=1)
+    quant.close()
+
+    # back to a fresh graph (also resets the learning phase)
+    clear_model_cache()
+
+    if not stochastic:
+        diff = float(np.max(np.abs(quant_samples - keras_samples)))
+        if diff > tol:
+            return "%s model output differs by %s (tolerance %s)" % (quant.mode, diff, tol)
+        return None
+
+    # MC output: samples of the same input must differ, means must agree within sampling error
+    if not np.any(quant_samples[0] != quant_samples[1]):
+        return "%s MC dropout samples are identical, dropout was removed by the conversion " \
+               "(use the float32 model)" % quant.mode
+
+    std_err = np.sqrt((keras_samples.var(axis=0) + quant_samples.var(axis=0)) / CHECK_MC)
+    diff = float(np.max(np.abs(quant_samples.mean(axis=0) - keras_samples.mean(axis=0)) - 6 * std_err))
+    if diff > tol:
+        return "%s MC mean differs from the keras MC mean by %s beyond sampling error (tolerance %s)" % \
+               (quant.mode, diff, tol)
+    return None
+
+
+class QuantizedModel(FrozenModel):
+    """
+    Reduced-precision (TensorFlow Lite) model with the interface of FrozenModel
+    (no intermediate tensors, so MC Dropout runs the full model for each sample)
+    """
+
+    def __init__(self, quant_model, quant_info):
+        """
+        :param quant_model: tflite model (from quantize_model)
+        :param quant_info: model info (json)
+        """
+        import tensorflow as tf
+        from hippmapper.deep.session import get_session_config
+
+        with open(quant_info, 'r') as json_file:
+            info = json.load(json_file)
+
+        self.input_name = info['input']
+        self.output_name = info['output']
+        self.frontier_names = []
+        self.input_shape = tuple([None] + info['input_shape'])
+        self.channels_last = info['channels_last']
+        self.sample_memory = info['sample_memory']
+        self.mode = info['mode']
+
+        config = get_session_config()
+        num_threads = config.intra_op_parallelism_threads if config is not None else 0
+        try:
+            self.interpreter = tf.lite.Interpreter(model_path=quant_model, num_threads=num_threads or None)
+        except TypeError:
+            # older versions without thread setting
+            self.interpreter = tf.lite.Interpreter(model_path=quant_model)
+        self._input_index = self.interpreter.get_input_details()[0]['index']
+        self._output_index = self.interpreter.get_output_details()[0]['index']
+        self._batch_size = None
+        # interpreter is not thread-safe
+        self._lock = threading.Lock()
+
+    def _run(self, data):
+        if data.shape[0] != self._batch_size:
+            self.interpreter.resize_tensor_input(self._input_index, list(data.shape))
+            self.interpreter.allocate_tensors()
+            self._batch_size = data.shape[0]
+        self.interpreter.set_tensor(self._input_index, np.ascontiguousarray(data, dtype=np.float32))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self._output_index).copy()
+
+    def function(self, inputs, outputs):
+        """
+        Callable running the full model (only the model input and output are available)
+        :param inputs: input tensor names (model input)
+        :param outputs: output tensor names (model output)
+        :return: function returning list of outputs
+        """
+        if list(inputs) != [self.input_name] or list(outputs) != [self.output_name]:
+            raise ValueError("quantized models only run from model input to model output")
+
+        return lambda values: [self.predict(values[0])]
+
+    def predict(self, data, batch_size=None):
+        """
+        Predict in batches
+        :param data: input array
+        :param batch_size: samples per run (all if None)
+        :return: prediction
+        """
+        batch_size = batch_size or data.shape[0]
+        with self._lock:
+            return np.concatenate([self._run(data[start:start + batch_size])
+                                   for start in range(0, data.shape[0], batch_size)])
+
+    def close(self):
+        self.interpreter = None
+
+
+def dice(mask1, mask2):
+    """
+    Dice overlap of two binary masks (1 if both are empty)
+    """
+    total = np.count_nonzero(mask1) + np.count_nonzero(mask2)
+    return 2. * np.count_nonzero(mask1 & mask2) / total if total else 1.
+
+
+def accuracy_report(model_json, model_weights, mode, val, num_mc=30, thresh=0.5, out=None):
+    """
+    Compare reduced-precision and float32 predictions (Dice, volume difference, time) on validation inputs
+    :param model_json: model architecture (json)
+    :param model_weights: model weights (h5)
+    :param mode: float16 or int8
+    :param val: validation input images (model input shape)
+    :param num_mc: MC Dropout samples for models with dropout
+    :param thresh: threshold of predictions
+    :param out: report file (csv)
+    :return: list of per-case results
+    """
+    from hippmapper.deep.predict import load_old_model_json
+    from hippmapper.deep.mc_dropout import MCDropoutEngine, STOCHASTIC_LAYERS
+    from hippmapper.deep.convert_channels_last import is_channels_last, to_channels_last, to_channels_first
+
+    with open(model_json, 'r') as json_file:
+        model = load_old_model_json(json_file.read())
+    model.load_weights(model_weights)
+    quant_model = QuantizedModel(*quantized_files(model_json, mode))
+
+    stochastic = any(isinstance(layer, STOCHASTIC_LAYERS) for layer in model.layers)
+
+    def run(run_model, data):
+        if stochastic:
+            return MCDropoutEngine(run_model).predict(data, num_mc)[0]
+        if is_channels_last(run_model):
+            return to_channels_first(run_model.predict(to_channels_last(data)))[0, 0]
+        return run_model.predict(data)[0, 0]
+
+    results = []
+    for val_file in val:
+        img = nib.load(val_file)
+        data = np.asarray(img.dataobj, dtype=np.float32)[np.newaxis, np.newaxis]
+        voxel_vol = float(np.prod(img.header.get_zooms()[:3]))
+
+        start_time = time.time()
+        ref = run(model, data)
+        ref_time = time.time() - start_time
+
+        start_time = time.time()
+        quant = run(quant_model, data)
+        quant_time = time.time() - start_time
+
+        ref_mask, quant_mask = ref > thresh, quant > thresh
+        ref_vol, quant_vol = np.count_nonzero(ref_mask) * voxel_vol, np.count_nonzero(quant_mask) * voxel_vol
+
+        result = dict(case=val_file, dice=dice(ref_mask, quant_mask), ref_vol=ref_vol, quant_vol=quant_vol,
+                      vol_diff_pct=100. * (quant_vol - ref_vol) / ref_vol if ref_vol else 0.,
+                      max_prob_diff=float(np.max(np.abs(ref - quant))), ref_time=ref_time, quant_time=quant_time,
+                      speedup=ref_time / quant_time if quant_time else 0.)
+        print("\n %(case)s: Dice %(dice).4f, volume diff %(vol_diff_pct).2f%%, max prob diff %(max_prob_diff).3f, "
+              "speedup %(speedup).2fx" % result)
+        results.append(result)
+
+    if results:
+        print("\n %s vs float32 on %s cases: mean Dice %.4f (min %.4f), mean |volume diff| %.2f%%, "
+              "mean speedup %.2fx" %
+              (mode, len(results), np.mean([res['dice'] for res in results]),
+               np.min([res['dice'] for res in results]), np.mean([abs(res['vol_diff_pct']) for res in results]),
+               np.mean([res['speedup'] for res in results])))
+
+    if out is not None and results:
+        with open(out, 'w') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=list(results[0].keys()))
+            writer.writeheader()
+            writer.writerows(results)
+
+    return results
+
+
+def main(args):
+    parser = parsefn()
+    model_json, model_weights, mode, tol, val, num_mc, thresh, out = parse_inputs(parser, args)
+
+    quant_model, quant_info = quantize_model(model_json, model_weights, mode, tol=tol)
+    print("\n %s model saved to %s and %s" % (mode, quant_model, quant_info))
+
+    if val:
+        accuracy_report(model_json, model_weights, mode, val, num_mc=num_mc, thresh=thresh, out=out)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
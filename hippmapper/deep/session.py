@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# coding: utf-8
+
+import os
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
+
+# session config of the last configure_session call (also used by frozen graphs)
+_session_config = None
+_session_settings = None
+
+# thread counts of the math libraries (OpenMP / MKL / OpenBLAS)
+MATH_THREAD_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+
+def parse_cpu_list(cpus):
+    """
+    Parse list of cpus
+    :param cpus: cpu list string (e.g. '0-3,8') or iterable of cpu ids
+    :return: set of cpu ids
+    """
+    if not isinstance(cpus, str):
+        return set(int(cpu) for cpu in cpus)
+
+    cpu_ids = set()
+    for part in cpus.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpu_ids.update(range(int(first), int(last) + 1))
+        else:
+            cpu_ids.add(int(part))
+
+    return cpu_ids
+
+
+def set_cpu_affinity(cpus):
+    """
+    Pin this process (and threads it starts later) to a set of cpus
+    :param cpus: cpu list string (e.g. '0-3,8') or iterable of cpu ids
+    :return: set of cpu ids used (None if affinity is not supported on this platform)
+    """
+    if not hasattr(os, 'sched_setaffinity'):
+        print("\n Warning: cpu affinity is not supported on this platform, ignoring it")
+        return None
+
+    cpu_ids = parse_cpu_list(cpus)
+    os.sched_setaffinity(0, cpu_ids)
+
+    return cpu_ids
+
+
+def set_math_threads(omp_threads):
+    """
+    Set threads of the math libraries (OpenMP / MKL / OpenBLAS). The environment variables are read when the
+    libraries load (numpy, TensorFlow), so they only apply if set before these imports (the cli sets them
+    before importing a subcommand). Libraries that are already loaded are limited with threadpoolctl if it
+    is installed
+    :param omp_threads: number of threads
+    :return: True if the limit was applied to the loaded libraries
+    """
+    for env_var in MATH_THREAD_VARS:
+        os.environ[env_var] = str(omp_threads)
+
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return False
+
+    threadpool_limits(limits=omp_threads)
+
+    return True
+
+
+def configure_session(intra_op_threads=None, inter_op_threads=None, omp_threads=None, cpus=None):
+    """
+    Configure threading of TensorFlow and the math libraries (OpenMP / MKL) used for CPU inference,
+    so several jobs can share a node without oversubscribing it. Should be called before models are built
+    (cached models are dropped as they belong to the previous session, unless the settings did not change)
+    :param intra_op_threads: threads used within an op (TensorFlow default: all cores if None)
+    :param inter_op_threads: threads running independent ops in parallel (TensorFlow default if None)
+    :param omp_threads: OpenMP / MKL threads (intra_op_threads if None)
+    :param cpus: cpus to pin the process to, e.g. '0-3,8' (no pinning if None)
+    :return: TensorFlow session
+    """
+    global _session_config, _session_settings
+
+    settings = (intra_op_threads, inter_op_threads, omp_threads,
+                tuple(sorted(parse_cpu_list(cpus))) if cpus is not None else None)
+    if _session_config is not None and settings == _session_settings:
+        # same settings (e.g. jobs of a long-running process), keep session and cached models
+        from keras import backend as K
+        return K.get_session()
+
+    if cpus is not None:
+        set_cpu_affinity(cpus)
+
+    omp_threads = intra_op_threads if omp_threads is None else omp_threads
+    if omp_threads is not None:
+        set_math_threads(omp_threads)
+
+    import tensorflow as tf
+    from keras import backend as K
+    from hippmapper.deep.predict import clear_model_cache
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads or 0,
+                            inter_op_parallelism_threads=inter_op_threads or 0,
+                            allow_soft_placement=True)
+
+    _session_config = config
+    _session_settings = settings
+    # clearing the Keras session resets the default graph, keep its random seed (set e.g. by the caller)
+    graph_seed = tf.get_default_graph().seed
+    clear_model_cache()
+    if graph_seed is not None:
+        tf.set_random_seed(graph_seed)
+    session = tf.Session(config=config)
+    K.set_session(session)
+
+    return session
+
+
+def get_session_config():
+    """
+    Session config set by configure_session
+    :return: TensorFlow ConfigProto (None for TensorFlow defaults)
+    """
+    return _session_config
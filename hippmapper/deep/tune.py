@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import os
+import sys
+import json
+import time
+import argcomplete
+import argparse
+import numpy as np
+from termcolor import colored
+from hippmapper.utils.sys_utils import reset_peak_rss, peak_rss, cpu_model, total_memory
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
+
+STAGE1_SHAPE = (1, 1, 160, 160, 128)
+ZOOM_SHAPE = (1, 1, 112, 112, 64)
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage="%(prog)s \n\n"
+                                           "Benchmark thread counts and MC batch sizes of the segmentation models "
+                                           "on this machine and save the best configuration (used by seg_hipp)\n\n"
+                                           "Examples: \n"
+                                           "    hippmapper tune \n"
+                                           "OR (to try specific settings)\n"
+                                           "    hippmapper tune -ita 4 8 16 -mb 2 4 8 \n")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-ita', '--intra_threads', type=int, nargs='+', metavar='',
+                          help="intra-op thread counts to try (default: powers of 2 up to the number of cpus)")
+    optional.add_argument('-ite', '--inter_threads', type=int, nargs='+', metavar='', default=[1, 2],
+                          help="inter-op thread counts to try (default: %(default)s)")
+    optional.add_argument('-mb', '--mc_batch', type=int, nargs='+', metavar='',
+                          help="MC batch sizes to try (default: powers of 2 up to num_mc)")
+    optional.add_argument('-n', '--num_mc', type=int, metavar='', default=30,
+                          help="number of MC Dropout samples per run (default: %(default)s)")
+    optional.add_argument('-r', '--repeats', type=int, metavar='', default=3,
+                          help="timed runs per setting (default: %(default)s)")
+    optional.add_argument('-mf', '--mem_fraction', type=float, metavar='', default=0.5,
+                          help="max fraction of available memory a setting may use (default: %(default)s)")
+    optional.add_argument('-o', '--out', type=str, metavar='',
+                          help="output config file (default: %s)" % config_file())
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    n_cpus = num_cpus()
+    intra_threads = args.intra_threads if args.intra_threads else \
+        sorted(set([2 ** exp for exp in range(int(np.log2(n_cpus)) + 1)] + [n_cpus]))
+    inter_threads = args.inter_threads
+    mc_batch = args.mc_batch if args.mc_batch else \
+        sorted(set([2 ** exp for exp in range(int(np.log2(args.num_mc)) + 1)] + [args.num_mc]))
+    out = args.out if args.out is not None else config_file()
+
+    return intra_threads, inter_threads, mc_batch, args.num_mc, args.repeats, args.mem_fraction, out
+
+
+def num_cpus():
+    """
+    Number of cpus this process may run on
+    :return: number of cpus
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def machine_key():
+    """
+    Key of this machine type in the config file: cpu model, number of cpus and total memory, so nodes of the
+    same type share their tuned settings (a shared config file is tuned once per node type)
+    :return: machine key
+    """
+    mem = total_memory()
+    return '%s_%scpu%s' % (cpu_model(), num_cpus(), '_%sGB' % int(round(mem / 1024. ** 3)) if mem else '')
+
+
+def config_file():
+    """
+    Tuning config file (HIPPMAPPER_CONFIG or ~/.hippmapper/tune.json)
+    :return: config file path
+    """
+    return os.environ.get('HIPPMAPPER_CONFIG', os.path.join(os.path.expanduser('~'), '.hippmapper', 'tune.json'))
+
+
+def load_tuned_config(in_file=None):
+    """
+    Load tuned configuration of this machine
+    :param in_file: config file (default: config_file())
+    :return: config dict (intra_threads, inter_threads, mc_batch, ...), None if this machine was not tuned
+    """
+    in_file = config_file() if in_file is None else in_file
+    if not os.path.exists(in_file):
+        return None
+
+    try:
+        with open(in_file, 'r') as json_file:
+            configs = json.load(json_file)
+    except (IOError, OSError, ValueError):
+        print("\n Warning: could not read tuned config %s, ignoring it" % in_file)
+        return None
+
+    return configs.get(machine_key())
+
+
+def save_tuned_config(config, out_file=None):
+    """
+    Save tuned configuration of this machine (configs of other machines in the file are kept)
+    :param config: config dict
+    :param out_file: config file (default: config_file())
+    """
+    out_file = config_file() if out_file is None else out_file
+    if os.path.dirname(out_file):
+        os.makedirs(os.path.dirname(out_file), exist_ok=True)
+
+    configs = {}
+    if os.path.exists(out_file):
+        try:
+            with open(out_file, 'r') as json_file:
+                configs = json.load(json_file)
+        except (IOError, OSError, ValueError):
+            pass
+
+    configs[machine_key()] = config
+
+    with open(out_file, 'w') as json_file:
+        json.dump(configs, json_file, indent=2, sort_keys=True)
+
+
+def time_runs(run_fn, repeats):
+    """
+    Median run time (after one warm-up run)
+    :param run_fn: function to time
+    :param repeats: timed runs
+    :return: median time in seconds
+    """
+    run_fn()
+    times = []
+    for _ in range(max(1, repeats)):
+        start_time = time.time()
+        run_fn()
+        times.append(time.time() - start_time)
+
+    return float(np.median(times))
+
+
+def benchmark(model_files, intra_threads, inter_threads, mc_batch, num_mc, repeats, mem_limit):
+    """
+    Benchmark stage 1 and zoom models on synthetic inputs for one thread setting
+    :param model_files: (stage 1 json, weights, zoom json, weights)
+    :param intra_threads: intra-op threads
+    :param inter_threads: inter-op threads
+    :param mc_batch: MC batch sizes to try
+    :param num_mc: number of MC samples
+    :param repeats: timed runs per setting
+    :param mem_limit: max peak memory in bytes (None for no limit)
+    :return: list of results (dicts)
+    """
+    from hippmapper.deep.session import configure_session
+    from hippmapper.deep.predict import load_model, load_mc_engine
+    from hippmapper.deep.convert_channels_last import is_channels_last, to_channels_last
+
+    configure_session(intra_op_threads=intra_threads, inter_op_threads=inter_threads)
+
+    model_json, model_weights, model_zoom_json, model_zoom_weights = model_files
+    stage1_data = np.random.randn(*STAGE1_SHAPE).astype(np.float32)
+    zoom_data = np.random.randn(*ZOOM_SHAPE).astype(np.float32)
+
+    model = load_model(model_json, model_weights)
+    if is_channels_last(model):
+        stage1_data = to_channels_last(stage1_data)
+    stage1_time = time_runs(lambda: model.predict(stage1_data, batch_size=1), repeats)
+
+    results = []
+    for batch_size in mc_batch:
+        engine = load_mc_engine(model_zoom_json, model_zoom_weights, batch_size=batch_size)
+
+        reset_peak_rss()
+        try:
+            zoom_time = time_runs(lambda: engine.predict_stats(zoom_data, num_mc), repeats)
+        except Exception as error:
+            # e.g. out of memory
+            print("\n intra %s, inter %s, MC batch %s failed: %s" % (intra_threads, inter_threads, batch_size,
+                                                                    str(error).split('\n')[0]))
+            continue
+        mem = peak_rss()
+
+        result = dict(intra_threads=intra_threads, inter_threads=inter_threads, mc_batch=batch_size,
+                      stage1_time=stage1_time, zoom_time=zoom_time, samples_per_sec=num_mc / zoom_time,
+                      subj_time=stage1_time + zoom_time, peak_rss_mb=mem / 1024. ** 2,
+                      fits=mem_limit is None or mem <= mem_limit)
+        print("\n intra %(intra_threads)s, inter %(inter_threads)s, MC batch %(mc_batch)s: "
+              "stage 1 %(stage1_time).2fs, zoom %(zoom_time).2fs (%(samples_per_sec).1f samples/s), "
+              "peak memory %(peak_rss_mb).0f MB" % result)
+        results.append(result)
+
+    return results
+
+
+# --------------
+# Main function
+# --------------
+def main(args):
+    """
+    Benchmark thread counts and MC batch sizes and save the fastest setting that fits in memory
+    :param args: intra_threads, inter_threads, mc_batch, num_mc, repeats, mem_fraction, out
+    :return: best config
+    """
+    parser = parsefn()
+    intra_threads, inter_threads, mc_batch, num_mc, repeats, mem_fraction, out = parse_inputs(parser, args)
+
+    from hippmapper.utils.sys_utils import available_memory
+    from hippmapper.segment.hippmapper import model_files
+
+    models = model_files()
+
+    avail = available_memory()
+    mem_limit = avail * mem_fraction if avail is not None else None
+
+    print(colored("\n benchmarking on %s: intra threads %s, inter threads %s, MC batch %s" %
+                  (machine_key(), intra_threads, inter_threads, mc_batch), 'green'))
+
+    results = []
+    for intra in intra_threads:
+        for inter in inter_threads:
+            results += benchmark(models, intra, inter, mc_batch, num_mc, repeats, mem_limit)
+
+    candidates = [result for result in results if result['fits']] or results
+    assert candidates, "all settings failed ... please check the models and try smaller MC batches"
+
+    best = min(candidates, key=lambda result: result['subj_time'])
+    config = dict(intra_threads=best['intra_threads'], inter_threads=best['inter_threads'],
+                  mc_batch=best['mc_batch'], num_mc=num_mc, subj_time=best['subj_time'], results=results)
+    save_tuned_config(config, out)
+
+    print(colored("\n best: intra threads %s, inter threads %s, MC batch %s (%.2fs per subject), saved to %s" %
+                  (best['intra_threads'], best['inter_threads'], best['mc_batch'], best['subj_time'], out), 'green'))
+
+    return config
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+# coding: utf-8
+
+import os
+import threading
+import numpy as np
+import nibabel as nib
+
+from hippmapper.segment import hippmapper as hm
+from hippmapper.utils.sys_utils import stage_memory
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
+
+# models are shared by all engines of the process, forward passes run one at a time
+_INFERENCE_LOCK = threading.Lock()
+
+# labels of the segmentation (as in stats_hp)
+LABELS = {'Right_HP': 1, 'Left_HP': 2}
+
+
+def _orient_like(img, ref_img):
+    """
+    Flip / transpose image (in memory) back to the voxel axes of a reference with the same grid
+    """
+    ornt = nib.orientations.ornt_transform(nib.orientations.io_orientation(img.affine),
+                                           nib.orientations.io_orientation(ref_img.affine))
+    data = nib.orientations.apply_orientation(np.asanyarray(img.dataobj), ornt)
+    out_img = nib.Nifti1Image(data, img.affine.dot(nib.orientations.inv_ornt_aff(ornt, img.shape)), img.header)
+    out_img.set_data_dtype(img.get_data_dtype())
+
+    return out_img
+
+
+class HippMapper(object):
+    """
+    Hippocampus segmentation engine for use as a library: models and settings are loaded once, images are
+    segmented in memory (no argument parsing, no output files). segment can be called repeatedly and from
+    several threads (pre-processing runs in parallel, forward passes one at a time)
+
+    Example:
+        engine = HippMapper(num_mc=30)
+        result = engine.segment(nib.load('mprage.nii.gz'))
+        result['seg'], result['volumes']
+    """
+
+    def __init__(self, num_mc=30, mc_batch=None, thresh=0.5, adaptive_mc=False, min_mc=10, mc_tol=0.005,
+                 mc_criterion='mask', uncertainty=True, ign_ort=False, channels_last=True, frozen=True,
+                 quantized=None, tuned=True, intra_threads=None, inter_threads=None, omp_threads=None, cpus=None):
+        """
+        Settings (model variants, tuned config, threads) apply to the whole process, as in seg_hipp
+        :param num_mc: number of Monte Carlo Dropout samples (maximum if adaptive_mc)
+        :param mc_batch: MC samples per forward pass (tuned or auto-sized from available memory if None)
+        :param thresh: threshold of the probability map
+        :param adaptive_mc: stop drawing MC samples once the mean prediction converges
+        :param min_mc: minimum number of MC samples if adaptive_mc
+        :param mc_tol: adaptive MC tolerance
+        :param mc_criterion: adaptive MC convergence criterion: mask or mean
+        :param uncertainty: return MC Dropout uncertainty maps (variance, entropy, mutual_info)
+        :param ign_ort: ignore orientation (no re-orientation to RPI or LPI)
+        :param channels_last: use channels-last versions of the models when converted
+        :param frozen: use frozen graphs of the models when exported
+        :param quantized: use reduced-precision (float16 or int8) versions of the models (float32 if None)
+        :param tuned: use settings saved by hippmapper tune for this machine
+        :param intra_threads: TensorFlow threads within an op
+        :param inter_threads: TensorFlow threads running independent ops
+        :param omp_threads: OpenMP / MKL threads
+        :param cpus: cpus to pin the process to, e.g. '0-3,8'
+        """
+        from hippmapper.deep.predict import load_model
+
+        self.mc_batch = hm.configure_inference(channels_last=channels_last, frozen=frozen, quantized=quantized,
+                                               tuned=tuned, mc_batch=mc_batch, intra_threads=intra_threads,
+                                               inter_threads=inter_threads, omp_threads=omp_threads, cpus=cpus)
+        self.num_mc = num_mc
+        self.thresh = thresh
+        self.adaptive_mc = dict(adaptive=adaptive_mc, min_mc=min(min_mc, num_mc), tol=mc_tol,
+                                criterion=mc_criterion)
+        self.uncertainty = uncertainty
+        self.ign_ort = ign_ort
+
+        self.model_json, self.model_weights, self.model_zoom_json, self.model_zoom_weights = hm.model_files()
+
+        # build both models now (kept in the process-wide model cache)
+        load_model(self.model_json, self.model_weights)
+        load_model(self.model_zoom_json, self.model_zoom_weights)
+
+    @staticmethod
+    def to_image(image, affine=None):
+        """
+        Image to segment as a nibabel image
+        :param image: nibabel image, or 3D array (with affine)
+        :param affine: voxel to world affine of an array
+        :return: nibabel image
+        """
+        if isinstance(image, nib.spatialimages.SpatialImage):
+            return image
+
+        if affine is None:
+            raise ValueError("an affine is needed to segment an array")
+        data = np.asanyarray(image)
+        if data.ndim != 3:
+            raise ValueError("expected a 3D image, got an array of shape %s" % (data.shape,))
+
+        return nib.Nifti1Image(data, np.asarray(affine, dtype=np.float64))
+
+    def preprocess(self, image, affine=None):
+        """
+        Pre-process an image for the models (CPU only, can run in a worker thread)
+        :param image: nibabel image, or 3D array (with affine)
+        :param affine: voxel to world affine of an array
+        :return: pre-processed image
+        """
+        in_img = self.to_image(image, affine)
+
+        with stage_memory('pre-processing'):
+            prep = hm.preprocess_img(in_img, ign_ort=self.ign_ort)
+        prep.update(subj='image', t1_name='image', pred_name='hipp_pred', pred_dir=None, in_img=in_img,
+                    t1_ref_img=prep['ort_img'], thresh=self.thresh, num_mc=self.num_mc, mc_batch=self.mc_batch,
+                    adaptive_mc=self.adaptive_mc, uncertainty=self.uncertainty, model_json=self.model_json,
+                    model_weights=self.model_weights, model_zoom_json=self.model_zoom_json,
+                    model_zoom_weights=self.model_zoom_weights)
+
+        return prep
+
+    def postprocess(self, prep, pred_zoom, uncert_maps, mc_info):
+        """
+        Segmentation outputs of a pre-processed image in the space of the input image
+        :param prep: pre-processed image (after the models ran)
+        :param pred_zoom: MC Dropout mean prediction
+        :param uncert_maps: uncertainty images
+        :param mc_info: MC info (num_samples, batch_times)
+        :return: result dict: seg (label map, right: 1, left: 2), prob (probability map), uncertainty
+         (dict of maps, empty if not asked for), volumes (mm3 per label), mc_info
+        """
+        with stage_memory('post-processing'):
+            outputs = hm.postprocess_subj(prep, pred_zoom, uncert_maps)
+
+        # back to the voxel axes of the input if it was re-oriented
+        if prep['reoriented']:
+            for key in ('seg', 'prob'):
+                outputs[key] = _orient_like(outputs[key], prep['in_img'])
+            outputs['uncertainty'] = {name: _orient_like(img, prep['in_img'])
+                                      for name, img in outputs['uncertainty'].items()}
+
+        seg_data = np.asanyarray(outputs['seg'].dataobj)
+        voxel_vol = float(np.prod(outputs['seg'].header.get_zooms()[:3]))
+        volumes = {name: np.count_nonzero(seg_data == label) * voxel_vol for name, label in LABELS.items()}
+
+        return dict(seg=outputs['seg'], prob=outputs['prob'], uncertainty=outputs['uncertainty'], volumes=volumes,
+                    mc_info=mc_info)
+
+    def segment_batch(self, images, affines=None, subj_batch=None):
+        """
+        Segment several images, forward passes are batched across images. A failing image does not stop the others
+        :param images: list of nibabel images or 3D arrays
+        :param affines: list of affines of arrays (None for nibabel images)
+        :param subj_batch: images per stage 1 forward pass (all if None)
+        :return: list of results (see postprocess), or the error of images that failed
+        """
+        affines = [None] * len(images) if affines is None else affines
+
+        preps, results = [], [None] * len(images)
+        for img_id, (image, affine) in enumerate(zip(images, affines)):
+            try:
+                preps.append((img_id, self.preprocess(image, affine)))
+            except (Exception, SystemExit) as error:
+                results[img_id] = error
+
+        if not preps:
+            return results
+
+        with _INFERENCE_LOCK:
+            mc_results = hm.run_models([prep for _, prep in preps], subj_batch=subj_batch)
+
+        for (img_id, prep), mc_result in zip(preps, mc_results):
+            if isinstance(mc_result, BaseException):
+                results[img_id] = mc_result
+                continue
+            try:
+                results[img_id] = self.postprocess(prep, *mc_result)
+            except (Exception, SystemExit) as error:
+                results[img_id] = error
+
+        return results
+
+    def segment(self, image, affine=None):
+        """
+        Segment hippocampus of an image in memory
+        :param image: nibabel image, or 3D array (with affine)
+        :param affine: voxel to world affine of an array
+        :return: result dict: seg (label map, right: 1, left: 2), prob (probability map), uncertainty
+         (dict of maps, empty if not asked for), volumes (mm3 per label), mc_info
+        """
+        result = self.segment_batch([image], [affine])[0]
+        if isinstance(result, BaseException):
+            raise result
+
+        return result
@@ -6,30 +6,25 @@ import os
 import sys
 import glob
 from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import argcomplete
 import argparse
 import numpy as np
 import nibabel as nib
-import subprocess
-from nilearn.image import resample_img, resample_to_img, math_img, largest_connected_component_img
-from nilearn.image import reorder_img, new_img_like
-from hippmapper.deep.predict import run_test_case
 from hippmapper.utils import endstatement
-from hippmapper.preprocess import biascorr, trim_like
-from hippmapper.qc import seg_qc
-from hippmapper.utils.sitk_utils import resample_to_spacing, calculate_origin_offset
-from nipype.interfaces.fsl import maths
-from nipype.interfaces.c3 import C3d
+from hippmapper.utils.sys_utils import stage_memory, record_stage_memory, print_stage_memory
 from termcolor import colored
-from numpy.random import seed
-from tensorflow import set_random_seed
 
+# heavy dependencies (TensorFlow / Keras, nilearn, nipype, scipy, SimpleITK) are imported where they are used,
+# so parsing options (and submitting jobs to a running daemon) does not pay for them
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
 
-seed(1)
-set_random_seed(1)
+# stage 1 probabilities below this fraction of the threshold bound the region resampled back to the T1
+PRED_SUPPORT = 0.1
+
 
 def parsefn():
     parser = argparse.ArgumentParser(usage="%(prog)s -s [ subj ] \n\n"
@@ -41,19 +36,70 @@ def parsefn():
                                            "OR (to bias-correct before and overwrite existing segmentation)\n"
                                            "    hypermatter segment_hipp -t1 my_subj/mprage.nii.gz -b -f \n"
                                            "OR (to run for subj - looks for my_subj_T1_nu.nii.gz)\n"
-                                           "    hypermatter segment_hipp -s my_subj \n")
+                                           "    hypermatter segment_hipp -s my_subj \n"
+                                           "OR (to run for all subjects in a dir, loading the models once)\n"
+                                           "    hypermatter segment_hipp -bt my_study \n")
 
     optional = parser.add_argument_group('optional arguments')
 
     optional.add_argument('-s', '--subj', type=str, metavar='', help="input subject")
     optional.add_argument('-t1', '--t1w', type=str, metavar='', help="input T1-weighted")
+    optional.add_argument('-bt', '--batch', type=str, metavar='',
+                          help="batch of subjects processed in one run: text file listing subject dirs or T1 images "
+                               "(one per line), glob pattern (in quotes) or directory of subjects")
+    optional.add_argument('-pw', '--prep_workers', type=int, metavar='', default=1,
+                          help="batch mode: number of pre-processing workers running ahead of model inference "
+                               "(default: %(default)s)")
+    optional.add_argument('-pq', '--prep_queue', type=int, metavar='', default=2,
+                          help="batch mode: max number of subjects pre-processed ahead of inference, caps memory "
+                               "(default: %(default)s)")
+    optional.add_argument('-sb', '--subj_batch', type=int, metavar='', default=4,
+                          help="batch mode: max number of ready subjects predicted together in batched forward "
+                               "passes, at most prep_queue (default: %(default)s)")
+    optional.add_argument('-ita', '--intra_threads', type=int, metavar='',
+                          help="TensorFlow threads within an op (default: all cores)")
+    optional.add_argument('-ite', '--inter_threads', type=int, metavar='',
+                          help="TensorFlow threads running independent ops (default: TensorFlow default)")
+    optional.add_argument('-omp', '--omp_threads', type=int, metavar='',
+                          help="OpenMP / MKL threads (default: same as --intra_threads)")
+    optional.add_argument('-cpu', '--cpus', type=str, metavar='',
+                          help="cpus to pin the job to, e.g. 0-3,8 (to pack several jobs per node)")
+    optional.add_argument('-nt', '--no_tuned', help="ignore settings saved by 'hippmapper tune' for this machine",
+                          action='store_true')
+    optional.add_argument('-cf', '--channels_first', help="use the original channels-first models even if "
+                                                          "channels-last versions were converted", action='store_true')
+    optional.add_argument('-nf', '--no_frozen', help="build models from keras json + weights even if frozen "
+                                                     "graphs were exported", action='store_true')
+    optional.add_argument('-q', '--quantized', type=str, metavar='', choices=['float16', 'int8'],
+                          help="use reduced-precision (float16 or int8) versions of the models that were quantized")
+    optional.add_argument('-lc', '--local', help="run in this process even if a hippmapper serve daemon is running",
+                          action='store_true')
     optional.add_argument('-b', '--bias', help="bias field correct image before segmentation",
                           action='store_true')
     optional.add_argument('-o', '--out', type=str, metavar='', help="output prediction")
     optional.add_argument('-n', '--num_mc', type=int, metavar='', help="number of Monte Carlo Dropout samples",
                           default=30)
+    optional.add_argument('-mb', '--mc_batch', type=int, metavar='',
+                          help="number of MC samples per forward pass (default: auto-sized from available memory)")
+    optional.add_argument('-amc', '--adaptive_mc', help="stop drawing MC samples once the mean prediction "
+                                                         "converges (--num_mc is then the maximum)",
+                          action='store_true')
+    optional.add_argument('-nmin', '--min_mc', type=int, metavar='', help="minimum number of MC samples in adaptive "
+                                                                          "mode (default: %(default)s)", default=10)
+    optional.add_argument('-mtol', '--mc_tol', type=float, metavar='', default=0.005,
+                          help="adaptive MC tolerance: fraction of mask voxels changed (mask) or max voxel-wise "
+                               "change of mean probability (mean) (default: %(default)s)")
+    optional.add_argument('-mcr', '--mc_criterion', type=str, metavar='', choices=['mask', 'mean'], default='mask',
+                          help="adaptive MC convergence criterion: mask or mean (default: %(default)s)")
+    optional.add_argument('-u', '--uncertainty', help="save MC Dropout uncertainty maps "
+                                                      "(variance, predictive entropy, mutual information)",
+                          action='store_true')
     optional.add_argument('-th', '--thresh', type=float, metavar='', help="threshold", default=0.5)
     optional.add_argument('-f', '--force', help="overwrite existing segmentation", action='store_true')
+    optional.add_argument('-mem', '--mem_report', help="print peak memory (RSS) of each pipeline stage",
+                          action='store_true')
+    optional.add_argument('-si', '--save_interm', help="save intermediate images in pred_process dir "
+                                                       "(for debugging)", action='store_true')
     optional.add_argument('-ss', '--session', type=str, metavar='', help="input session for longitudinal studies")
     optional.add_argument("-ign_ort", "--ign_ort",  action='store_true',
                           help="ignore orientation if tag is wrong")
@@ -110,43 +156,62 @@ def parse_inputs(parser, args):
 
     num_mc = args.num_mc
 
-    return subj_dir, subj, t1, out, bias, ign_ort, num_mc, thresh, force
+    mc_batch = args.mc_batch
 
+    adaptive_mc = dict(adaptive=True if args.adaptive_mc else False, min_mc=min(args.min_mc, num_mc),
+                       tol=args.mc_tol, criterion=args.mc_criterion)
 
-def orient_img(in_img_file, orient_tag, out_img_file):
-    c3 = C3d()
-    c3.inputs.in_file = in_img_file
-    c3.inputs.args = "-orient %s" % orient_tag
-    c3.inputs.out_file = out_img_file
-    if os.path.exists(out_img_file):
-        print("\n %s already exists" % out_img_file)
-    else:
-        c3.run()
+    uncertainty = True if args.uncertainty else False
+
+    keep_interm = True if args.save_interm else False
+
+    return subj_dir, subj, t1, out, bias, ign_ort, num_mc, mc_batch, adaptive_mc, uncertainty, thresh, force, \
+        keep_interm
 
-def check_orient(in_img_file, r_orient, l_orient, out_img_file):
+
+def c3d_to_axcodes(orient_tag):
     """
-    Check image orientation and re-orient if not in standard orientation (RPI or LPI)
-    :param in_img_file: input_image
-    :param r_orient: right ras orientation
-    :param l_orient: left las orientation
-    :param out_img_file: output oriented image
+    Convert c3d (ITK) orientation code (axes pointing away from each letter) to nibabel axis codes
+    :param orient_tag: c3d orientation code (e.g. RPI)
+    :return: nibabel axis codes (e.g. ('L', 'A', 'S'))
     """
-    res = subprocess.run('c3d %s -info' % in_img_file, shell=True, stdout=subprocess.PIPE)
-    out = res.stdout.decode('utf-8')
-    ort_str = out.find('orient =') + 9
-    img_ort = out[ort_str:ort_str + 3]
+    opposite = {'R': 'L', 'L': 'R', 'A': 'P', 'P': 'A', 'I': 'S', 'S': 'I'}
+    return tuple(opposite[ax] for ax in orient_tag)
+
 
-    if (img_ort != r_orient) and (img_ort != l_orient):
+def orient_img(in_img, orient_tag):
+    """
+    Re-orient image in memory (as c3d -orient), data is a flipped/transposed view when possible
+    :param in_img: input image
+    :param orient_tag: c3d orientation code
+    :return: re-oriented image
+    """
+    ornt = nib.orientations.ornt_transform(nib.orientations.io_orientation(in_img.affine),
+                                           nib.orientations.axcodes2ornt(c3d_to_axcodes(orient_tag)))
+    data = nib.orientations.apply_orientation(np.asanyarray(in_img.dataobj), ornt)
+    affine = in_img.affine.dot(nib.orientations.inv_ornt_aff(ornt, in_img.shape))
+
+    return nib.Nifti1Image(data, affine, in_img.header)
+
+def check_orient(in_img, r_orient, l_orient):
+    """
+    Check image orientation (from header) and re-orient if not in standard orientation (RPI or LPI)
+    :param in_img: input_image
+    :param r_orient: right c3d orientation
+    :param l_orient: left c3d orientation
+    :return: image in standard orientation, whether it was re-oriented
+    """
+    img_ort = nib.aff2axcodes(in_img.affine)
+
+    if (img_ort != c3d_to_axcodes(r_orient)) and (img_ort != c3d_to_axcodes(l_orient)):
         print("\n Warning: input image is not in RPI or LPI orientation.. "
               "\n re-orienting image to standard orientation based on orient tags (please make sure they are correct)")
 
-        if img_ort == 'Obl':
-            img_ort = out[-5:-2]
-            orient_tag = 'RPI' if 'R' in img_ort else 'LPI'
-        else:
-            orient_tag = 'RPI' if 'R' in img_ort else 'LPI'
+        orient_tag = r_orient if 'L' in img_ort else l_orient
         print(orient_tag)
-        orient_img(in_img_file, orient_tag, out_img_file)
+        return orient_img(in_img, orient_tag), True
+
+    return in_img, False
 
 def resample(image, new_shape, interpolation="linear"):
     # """
@@ -164,92 +229,135 @@ def resample(image, new_shape, interpolation="linear"):
     # new_affine[:3, :3] = ras_image.affine[:3, :3] * np.diag(new_spacing)
     #
     # return resample_img(ras_image, target_affine=new_affine, target_shape=output_shape, interpolation=interpolation)
+    from nilearn.image import reorder_img, new_img_like
+    from hippmapper.utils.sitk_utils import resample_to_spacing, calculate_origin_offset
 
     image = reorder_img(image, resample=interpolation)
     zoom_level = np.divide(new_shape, image.shape)
     new_spacing = np.divide(image.header.get_zooms(), zoom_level)
-    new_data = resample_to_spacing(image.get_data(), image.header.get_zooms(), new_spacing, interpolation=interpolation)
+    new_data = resample_to_spacing(np.asanyarray(image.dataobj), image.header.get_zooms(), new_spacing,
+                                   interpolation=interpolation)
     new_affine = np.copy(image.affine)
     np.fill_diagonal(new_affine, new_spacing.tolist() + [1])
     new_affine[:3, 3] += calculate_origin_offset(new_spacing, image.header.get_zooms())
     return new_img_like(image, new_data, affine=new_affine)
 
-def threshold_img(t1, training_mod, thresh_val, thresh_file):
+def save_interm(img, pred_dir, name):
+    """
+    Save intermediate image for debugging (if pred_dir is given)
+    :param img: intermediate image
+    :param pred_dir: pred process dir (None to skip)
+    :param name: output file name
+    :return: intermediate image
+    """
+    if pred_dir is not None:
+        nib.save(img, os.path.join(pred_dir, name))
+    return img
+
+
+def threshold_img(t1, training_mod, thresh_val):
     """
-    Threshold image using fsl maths
+    Threshold image at a percentage of the robust range of non-zero voxels (as fslmaths -thrP)
     :param t1: input image
     :param training_mod: image name
-    :param thresh_val: threshold value (in percentile)
-    :param thresh_file: output thresholded image
+    :param thresh_val: threshold value (in percentage of robust range)
+    :return: thresholded image
+    """
+    from hippmapper.utils.intensity_utils import robust_range_value
+
+    print("\n pre-processing %s" % training_mod)
+    data = float32_data(t1)
+    thresh = robust_range_value(data, thresh_val)
+    if thresh is not None:
+        data[data < thresh] = 0
+
+    thresh_img = nib.Nifti1Image(data, t1.affine, t1.header)
+    thresh_img.set_data_dtype(np.float32)
+
+    return thresh_img
+
+
+def float32_data(img):
+    """
+    Image data as a float32 array owned by the caller (a copy if the image holds float32 data in memory,
+    scaled straight to float32 if loaded from file)
+    :param img: input image
+    :return: float32 array
     """
-    threshold = maths.Threshold()
-    threshold.inputs.in_file = t1
-    threshold.inputs.thresh = thresh_val
-    threshold.inputs.use_robust_range = True
-    threshold.inputs.use_nonzero_voxels = True
-    threshold.inputs.out_file = thresh_file
+    data = np.asarray(img.dataobj, dtype=np.float32)
+    if isinstance(img.dataobj, np.ndarray) and np.may_share_memory(data, img.dataobj):
+        data = data.copy()
 
-    if not os.path.exists(thresh_file):
-        print("\n pre-processing %s" % training_mod)
-        threshold.run()
+    return data
 
 
-def normalize_sample_wise_img(in_file, out_file):
-    image = nib.load(in_file)
-    img = image.get_data()
+def normalize_sample_wise_img(image):
+    """
+    Standardize image intensities (mean and std of all voxels, single pass, float32)
+    :param image: input image
+    :return: standardized image
+    """
+    from hippmapper.utils.intensity_utils import standardize
+
+    data = float32_data(image)
+
     # standardize intensity for data
     print("\n standardizing ...")
-    std_img = (img - img.mean()) / img.std()
-    nib.save(nib.Nifti1Image(std_img, image.affine), out_file)
-
-def standard_img(in_file, std_file):
-    """
-    Orient image in standard orientation
-    :param in_file: input image
-    :param std_file: output oriented image
-    """
-    c3 = C3d()
-    c3.inputs.in_file = in_file
-    file_shape = nib.load(in_file).shape
-    nx = int(file_shape[0] / 2.2)
-    ny = int(file_shape[1] / 2.2)
-    nz = int(file_shape[2] / 2.2)
-    c3.inputs.args = "-binarize -as m %s -push m -nlw %sx%sx%s -push m -times -replace nan 0" % (in_file, nx, ny, nz)
-    c3.inputs.out_file = std_file
-
-    if os.path.exists(std_file):
-        print("\n %s already exists" % std_file)
-    else:
-        c3.run()
+    return nib.Nifti1Image(standardize(data), image.affine)
 
-def get_largest_two_comps(in_img, out_comps):
+def standard_img(in_img):
     """
-    Get the two largest connected components
+    Standardize image intensities in a local window (mean and std of non-zero voxels)
     :param in_img: input image
-    :param out_comps: output image with two components
+    :return: standardized image
     """
-    first_comp = largest_connected_component_img(in_img)
-    residual = math_img('img1 - img2', img1=in_img, img2=first_comp)
-    second_comp = largest_connected_component_img(residual)
-    comb_comps = math_img('img1 + img2', img1=first_comp, img2=second_comp)
+    nx = int(in_img.shape[0] / 2.2)
+    ny = int(in_img.shape[1] / 2.2)
+    nz = int(in_img.shape[2] / 2.2)
+
+    from hippmapper.utils.intensity_utils import normalize_local_window
+
+    std_data = normalize_local_window(np.asanyarray(in_img.dataobj), (nx, ny, nz))
+
+    return nib.Nifti1Image(std_data, in_img.affine)
+
+def get_largest_two_comps(in_img):
+    """
+    Get the two largest connected components (single labeling pass within the mask bounding box)
+    :param in_img: input image
+    :return: image with two components (uint8)
+    """
+    from scipy import ndimage
+
+    mask = np.asanyarray(in_img.dataobj) != 0
+    out_data = np.zeros(mask.shape, dtype=np.uint8)
+
+    if mask.any():
+        bbox = ndimage.find_objects(mask.astype(np.uint8))[0]
+        labels, num_comps = ndimage.label(mask[bbox])
 
-    nib.save(comb_comps, out_comps)
+        sizes = np.bincount(labels.ravel())
+        sizes[0] = 0
+        largest = np.argsort(-sizes, kind='stable')[:min(2, num_comps)]
 
-def reslice_like(in_img, ref_img, trimmed_img):
-    c3 = C3d()
-    c3.inputs.in_file = ref_img
-    c3.inputs.args = "%s -reslice-identity" % in_img
-    c3.inputs.out_file = trimmed_img
-    c3.run()
+        out_data[bbox] = np.isin(labels, largest)
 
+    out_img = nib.Nifti1Image(out_data, in_img.affine, in_img.header)
+    out_img.set_data_dtype(np.uint8)
 
-def split_seg_sides(in_bin_seg_file, out_seg_file):
+    return out_img
+
+def reslice_like(in_img, ref_img):
+    from hippmapper.utils.reslice_utils import reslice_img
+    return reslice_img(in_img, ref_img, order=1)
+
+
+def split_seg_sides(in_bin_seg):
     """
     Split segmentation into Right/Left
-    :param in_bin_seg_file: input binary segmentation
-    :param out_seg_file: output segmentation with both sides
+    :param in_bin_seg: input binary segmentation
+    :return: segmentation with both sides
     """
-    in_bin_seg = nib.load(in_bin_seg_file)
     out_seg = in_bin_seg.get_data().copy()
     seg_ort = nib.aff2axcodes(in_bin_seg.affine)
     # print(seg_ort)
@@ -299,60 +407,173 @@ def split_seg_sides(in_bin_seg_file, out_seg_file):
     #     new[new == 1] = 2
     #     out_seg[0:mid, :, :] = new
 
-    out_seg_nii = nib.Nifti1Image(out_seg, in_bin_seg.affine)
-    nib.save(out_seg_nii, out_seg_file)
-
-def trim(img, out, voxels=1):
-    c3 = C3d()
-    c3.inputs.in_file = img
-    c3.inputs.args = "-trim %svox" % voxels
-    c3.inputs.out_file = out
-    if not os.path.exists(out):
-        print("\n cropping")
-        c3.run()
-
-def trim_like(img, ref, out, interp = 0):
-    c3 = C3d()
-    c3.inputs.in_file = ref
-    c3.inputs.args = "-int %s %s -reslice-identity" % (interp, img)
-    c3.inputs.out_file = out
-    if not os.path.exists(out):
-        print("\n cropping like")
-        c3.run()
-
-def trim_img_to_size(in_img, trimmed_img):
+    return nib.Nifti1Image(out_seg, in_bin_seg.affine)
+
+def trim(img, voxels=1):
+    from hippmapper.utils.reslice_utils import trim_img
+    print("\n cropping")
+    return trim_img(img, margin=voxels)
+
+def trim_like(img, ref, interp=0):
+    from hippmapper.utils.reslice_utils import reslice_img
+    print("\n cropping like")
+    return reslice_img(img, ref, order=interp)
+
+def trim_img_to_size(in_img):
     """
     Trim image to specific size (112x112x64mm)
     :param in_img: input image
-    :param trimmed_img: trimmed image
+    :return: trimmed image
     """
-    # trim(in_img, trimmed_img, voxels=20)
-    # file_shape = nib.load(trimmed_img).shape
-    # print(file_shape)
+    from hippmapper.utils.reslice_utils import trim_to_size
+    return trim_to_size(in_img, (112, 112, 64))
 
-    c3 = C3d()
-    c3.inputs.in_file = in_img
-    c3.inputs.args = "-trim-to-size 112x112x64vox"
-    # c3.inputs.args = "-trim-to-size %sx%sx%svox" % (file_shape[0], file_shape[0], int(file_shape[0]/2))
-    c3.inputs.out_file = trimmed_img
+def get_batch_inputs(batch):
+    """
+    Get subjects of a batch run
+    :param batch: text file (one subject dir or T1 image per line), glob pattern or directory of subjects
+    :return: list of subject dirs / T1 images
+    """
+    nii_exts = ('.nii', '.nii.gz', '.mnc', '.mgz')
+
+    if os.path.isdir(batch):
+        entries = [os.path.join(batch, entry) for entry in sorted(os.listdir(batch))]
+        subj_dirs = [entry for entry in entries if os.path.isdir(entry)]
+        inputs = subj_dirs if subj_dirs else [entry for entry in entries if entry.endswith(nii_exts)]
+    elif os.path.isfile(batch) and not batch.endswith(nii_exts):
+        with open(batch, 'r') as batch_file:
+            inputs = [line.strip() for line in batch_file if line.strip() and not line.startswith('#')]
+    else:
+        inputs = sorted(glob.glob(batch))
 
-    # if not os.path.exists(trimmed_img):
-    #     print("\n extracting hippocampus region")
-    c3.run()
+    assert inputs, "no subjects found in batch: %s" % batch
 
-# --------------
-# Main function
-# --------------
-def main(args):
+    return inputs
+
+
+def print_batch_status(status):
     """
-    Segment hippocampus using a trained CNN
-    :param args: subj_dir, subj, t1, out, bias, force
-    :return: prediction (segmentation file)
+    Print status table of a batch run
+    :param status: list of (subject, status, time, message)
     """
-    parser = parsefn()
-    subj_dir, subj, t1, out, bias, ign_ort, num_mc, thresh, force = parse_inputs(parser, args)
-    pred_name = 'T1acq_hipp_pred' if hasattr(args, 'subj') else 'hipp_pred'
+    width = max([len('subject')] + [len(subj) for subj, _, _, _ in status])
+
+    print("\n %s  %-7s  %-14s  %s" % ('subject'.ljust(width), 'status', 'time', 'output / error'))
+    for subj, subj_status, subj_time, message in status:
+        print(" %s  %-7s  %-14s  %s" % (subj.ljust(width), subj_status, subj_time, message))
+
+    counts = [len([st for _, st, _, _ in status if st == subj_status]) for subj_status in ('done', 'skipped', 'failed')]
+    print("\n %s subjects: %s done, %s skipped, %s failed" % tuple([len(status)] + counts))
+
+
+def preprocess_batch_input(parser, args, batch_input, pred_name):
+    """
+    Parse inputs and pre-process one subject of a batch (run by pre-processing workers)
+    :param parser: argument parser
+    :param args: parsed arguments (with batch)
+    :param batch_input: subject dir or T1 image
+    :param pred_name: prediction name
+    :return: prediction file, pre-processed subject (None if prediction already exists), pre-processing time
+    """
+    start_time = datetime.now()
+
+    subj_args = argparse.Namespace(**vars(args))
+    subj_args.batch = None
+    subj_args.subj, subj_args.t1w = (None, batch_input) if os.path.isfile(batch_input) else (batch_input, None)
+
+    prediction, prep = preprocess_subj(*parse_inputs(parser, subj_args), pred_name=pred_name)
+
+    return prediction, prep, datetime.now() - start_time
+
 
+def run_batch(parser, args, pred_name):
+    """
+    Segment a batch of subjects in one process (models are loaded once and reused), a failing subject
+    does not stop the batch. Pre-processing workers prepare the next subjects while the current ones are
+    predicted, at most prep_queue subjects are pre-processed (or being pre-processed) ahead of inference.
+    Subjects that are ready are predicted together (up to subj_batch, at most prep_queue) in batched forward passes,
+    so at most 2 x prep_queue pre-processed subjects are held in memory
+    :param parser: argument parser
+    :param args: parsed arguments (with batch)
+    :param pred_name: prediction name
+    :return: list of (subject, status, time, message)
+    """
+    assert args.out is None, "output (-o) cannot be used with batch (-bt), predictions are saved in subject dirs"
+
+    prep_queue = max(1, args.prep_queue)
+    subj_batch = max(1, min(args.subj_batch, prep_queue))
+    batch_inputs = iter(get_batch_inputs(args.batch))
+    pending = deque()
+    status = []
+
+    with ThreadPoolExecutor(max_workers=max(1, args.prep_workers)) as executor:
+
+        def fill_queue():
+            while len(pending) < prep_queue:
+                batch_input = next(batch_inputs, None)
+                if batch_input is None:
+                    break
+                pending.append((batch_input, executor.submit(preprocess_batch_input, parser, args, batch_input,
+                                                             pred_name)))
+
+        fill_queue()
+
+        while pending:
+            # wait for the next subject, then take the ones already pre-processed after it
+            group = []
+            while pending and len(group) < subj_batch and (not group or pending[0][1].done()):
+                batch_input, prep_future = pending.popleft()
+
+                try:
+                    prediction, prep, prep_time = prep_future.result()
+                except (Exception, SystemExit) as error:
+                    print(colored("\n segmentation failed for %s: %s" % (batch_input, error), 'red'))
+                    status.append((batch_input, 'failed', '', str(error).strip().split('\n')[0]))
+                    continue
+
+                if prep is None:
+                    status.append((batch_input, 'skipped', str(prep_time), prediction))
+                else:
+                    group.append((batch_input, prep, prep_time))
+
+            # keep workers busy while these subjects are predicted
+            fill_queue()
+
+            if not group:
+                continue
+
+            # inference time is shared evenly by the subjects of a group
+            start_time = datetime.now()
+            try:
+                results = predict_subjs([prep for _, prep, _ in group], subj_batch=subj_batch)
+            except (Exception, SystemExit) as error:
+                results = [error] * len(group)
+            group_time = (datetime.now() - start_time) / len(group)
+
+            for (batch_input, _, prep_time), result in zip(group, results):
+                if isinstance(result, BaseException):
+                    print(colored("\n segmentation failed for %s: %s" % (batch_input, result), 'red'))
+                    status.append((batch_input, 'failed', str(prep_time + group_time),
+                                   str(result).strip().split('\n')[0]))
+                else:
+                    status.append((batch_input, 'done', str(prep_time + group_time), result))
+
+    print_batch_status(status)
+
+    return status
+
+
+def preprocess_subj(subj_dir, subj, t1, out, bias, ign_ort, num_mc, mc_batch, adaptive_mc, uncertainty, thresh, force,
+                    keep_interm, pred_name):
+    """
+    Pre-process one subject for the initial (stage 1) prediction: bias correction, orientation, thresholding,
+    standardization, cropping and resampling (CPU only, can run in a worker thread)
+    :param subj_dir: subject dir
+    :param subj: subject name
+    :param t1: input T1-weighted image
+    :param out: output prediction (in subject dir if None)
+    :return: prediction file, pre-processed subject (None if prediction already exists)
+    """
     if out is None:
         prediction = os.path.join(subj_dir, "%s_%s.nii.gz" % (subj, pred_name))
     else:
@@ -360,173 +581,430 @@ def main(args):
 
     if os.path.exists(prediction) and force is False:
         print("\n %s already exists" % prediction)
+        return prediction, None
 
-    else:
-        start_time = datetime.now()
-
-        hfb = os.path.realpath(__file__)
-        hyper_dir = str(Path(hfb).parents[2])
+    start_time = datetime.now()
 
-        model_json = os.path.join(hyper_dir, 'models', 'hipp_model.json')
-        model_weights = os.path.join(hyper_dir, 'models', 'hipp_model_weights.h5')
+    model_json, model_weights, model_zoom_json, model_zoom_weights = model_files()
 
-        assert os.path.exists(
-            model_weights), "%s model does not exits ... please download and rerun script" % model_weights
-
-        # pred preprocess dir
+    # pred preprocess dir (intermediates are kept in memory unless asked for)
+    if keep_interm:
         pred_dir = os.path.join('%s' % os.path.abspath(subj_dir), 'pred_process')
         if not os.path.exists(pred_dir):
             os.mkdir(pred_dir)
+    else:
+        pred_dir = None
 
-        training_mod = "t1"
+    t1_name = os.path.basename(t1).split('.')[0]
+
+    if bias is True:
+        from hippmapper.preprocess import biascorr
+
+        t1_bias = os.path.join(subj_dir, "%s_nu.nii.gz" % t1_name)
+        biascorr.main(["-i", "%s" % t1, "-o", "%s" % t1_bias])
+        in_ort = t1_bias
+    else:
+        in_ort = t1
+
+    with stage_memory('pre-processing'):
+        prep = preprocess_img(nib.load(in_ort), ign_ort=ign_ort, pred_dir=pred_dir, t1_name=t1_name)
+
+    if prep['reoriented']:
+        t1_ref_img, qc_img = prep['ort_img'], in_ort
+    else:
+        t1_ref_img, qc_img = nib.load(t1), t1
+
+    prep.update(subj_dir=subj_dir, subj=subj, t1_name=t1_name, pred_name=pred_name, prediction=prediction,
+                pred_dir=pred_dir, thresh=thresh, num_mc=num_mc, mc_batch=mc_batch, adaptive_mc=adaptive_mc,
+                uncertainty=uncertainty, model_json=model_json, model_weights=model_weights,
+                model_zoom_json=model_zoom_json, model_zoom_weights=model_zoom_weights, t1_ref_img=t1_ref_img,
+                qc_img=qc_img, start_time=start_time)
+
+    return prediction, prep
 
-        if bias is True:
-            t1_bias = os.path.join(subj_dir, "%s_nu.nii.gz" % os.path.basename(t1).split('.')[0])
-            biascorr.main(["-i", "%s" % t1, "-o", "%s" % t1_bias])
-            in_ort = t1_bias
-        else:
-            in_ort = t1
 
-        # check orientation
-        r_orient = 'RPI'
-        l_orient = 'LPI'
-        t1_ort = os.path.join(subj_dir, "%s_std_orient.nii.gz" % os.path.basename(t1).split('.')[0])
+def model_files():
+    """
+    Files of the stage 1 and zoom (MC Dropout) models
+    :return: model json, model weights, zoom model json, zoom model weights
+    """
+    hfb = os.path.realpath(__file__)
+    hyper_dir = str(Path(hfb).parents[2])
+
+    model_json = os.path.join(hyper_dir, 'models', 'hipp_model.json')
+    model_weights = os.path.join(hyper_dir, 'models', 'hipp_model_weights.h5')
+
+    assert os.path.exists(
+        model_weights), "%s model does not exits ... please download and rerun script" % model_weights
+
+    model_zoom_json = os.path.join(hyper_dir, 'models', 'hipp_zoom_full_mcdp_model.json')
+    model_zoom_weights = os.path.join(hyper_dir, 'models', 'hipp_zoom_full_mcdp_model_weights.h5')
+
+    assert os.path.exists(
+        model_zoom_weights), "%s model does not exits ... please download and rerun script" % model_zoom_weights
+
+    return model_json, model_weights, model_zoom_json, model_zoom_weights
+
+
+def preprocess_img(in_img, ign_ort=False, pred_dir=None, t1_name='t1'):
+    """
+    Pre-process an image in memory for the initial (stage 1) prediction: orientation, thresholding,
+    standardization, cropping and resampling
+    :param in_img: input T1-weighted image
+    :param ign_ort: ignore orientation (no re-orientation to RPI or LPI)
+    :param pred_dir: dir of intermediate images (not saved if None)
+    :param t1_name: name of intermediate images
+    :return: pre-processed image (stage 1 model input test_data and res, ort_img in standard orientation
+     and whether it was re-oriented)
+    """
+    training_mod = "t1"
+
+    # check orientation (in memory, no file written)
+    r_orient = 'RPI'
+    l_orient = 'LPI'
+    ort_img, reoriented = in_img, False
+
+    if ign_ort is False:
+        ort_img, reoriented = check_orient(ort_img, r_orient, l_orient)
+
+    if reoriented:
+        save_interm(ort_img, pred_dir, "%s_std_orient.nii.gz" % t1_name)
+
+    # threshold at 10 percentile of non-zero voxels
+    thresh_img = threshold_img(ort_img, training_mod, 10)
+    save_interm(thresh_img, pred_dir, "%s_thresholded.nii.gz" % t1_name)
+
+    # standardize
+    std_img = standard_img(thresh_img)
+    save_interm(std_img, pred_dir, "%s_thresholded_standardized.nii.gz" % t1_name)
+
+    # cropping
+    t1_crop_img = trim(std_img)
+    save_interm(t1_crop_img, pred_dir, "%s_thresholded_standardized_cropped.nii.gz" % t1_name)
+
+    # resample images
+    res = resample(t1_crop_img, [160, 160, 128])
+    save_interm(res, pred_dir, "%s_thresholded_resampled.nii.gz" % t1_name)
+
+    test_data = np.zeros((1, 1, 160, 160, 128), dtype=np.float32)
+    test_data[0, 0, :, :, :] = np.asanyarray(res.dataobj)
+
+    # the hippocampal region is read again from ort_img (a partial read when it is loaded from file)
+    return dict(test_data=test_data, res=res, ort_img=ort_img, reoriented=reoriented)
+
+
+def prepare_zoom(prep, pred):
+    """
+    Crop the hippocampal region around the initial prediction and pre-process it for the zoom model
+    :param prep: pre-processed subject (from preprocess_subj), updated with the zoom model input
+    :param pred: initial (stage 1) prediction
+    :return: pre-processed subject
+    """
+    from hippmapper.utils.reslice_utils import resample_roi
+
+    subj, t1_name, pred_dir, thresh, ort_img, t1_ref_img = \
+        [prep[key] for key in ('subj', 't1_name', 'pred_dir', 'thresh', 'ort_img', 't1_ref_img')]
+
+    # resample back and threshold, only around the voxels of the prediction that can reach the threshold
+    pred_th = resample_roi(pred, t1_ref_img, support=thresh * PRED_SUPPORT, thresh=thresh)
+
+    # largest conn comp
+    init_pred = get_largest_two_comps(pred_th)
+    save_interm(init_pred, pred_dir, "%s_hipp_init_pred.nii.gz" % subj)
+
+    # trim seg to size
+    trim_seg = trim(init_pred, voxels=10)
+    save_interm(trim_seg, pred_dir, "%s_hipp_init_pred_trimmed.nii.gz" % subj)
+
+    # trim t1 (not thresholded, as in the original pipeline)
+    t1_zoom_img = trim_like(ort_img, trim_seg, interp=3)
+    save_interm(t1_zoom_img, pred_dir, "%s_hipp_region.nii.gz" % subj)
+
+    # --------------
+    # 2nd model
+    # --------------
+
+    pred_shape = [112, 112, 64]
+
+    test_zoom_data = np.zeros((1, 1, pred_shape[0], pred_shape[1], pred_shape[2]), dtype=np.float32)
+
+    # standardize (on a copy: the region can be a view of ort_img)
+    t1_zoom_std = normalize_sample_wise_img(t1_zoom_img)
+    save_interm(t1_zoom_std, pred_dir, "%s_trimmed_standardized.nii.gz" % t1_name)
+
+    # resample images
+    res_zoom = resample(t1_zoom_std, pred_shape)
+    save_interm(res_zoom, pred_dir, "%s_trimmed_resampled.nii.gz" % t1_name)
+
+    test_zoom_data[0, 0, :, :, :] = np.asanyarray(res_zoom.dataobj)
+
+    prep.update(t1_zoom_img=t1_zoom_img, res_zoom=res_zoom, test_zoom_data=test_zoom_data)
+
+    return prep
+
+
+def save_subj_outputs(prep, pred_zoom, uncert_maps, mc_info):
+    """
+    Bring zoom model prediction (and uncertainty maps) back to the subject space, save outputs and QC
+    :param prep: pre-processed subject (from prepare_zoom)
+    :param pred_zoom: MC Dropout mean prediction
+    :param uncert_maps: uncertainty images
+    :param mc_info: MC info (num_samples, batch_times)
+    :return: prediction file
+    """
+    from hippmapper.qc import seg_qc
+
+    subj_dir, subj, pred_name, prediction, num_mc, adaptive_mc, qc_img, start_time = \
+        [prep[key] for key in ('subj_dir', 'subj', 'pred_name', 'prediction', 'num_mc', 'adaptive_mc', 'qc_img',
+                               'start_time')]
+
+    for batch_id, batch_time in enumerate(mc_info['batch_times']):
+        print("\n MC batch %s done in %.2fs" % (batch_id + 1, batch_time))
+
+    if adaptive_mc['adaptive']:
+        print("\n MC Dropout used %s of max %s samples" % (mc_info['num_samples'], num_mc))
+
+    with stage_memory('post-processing'):
+        outputs = postprocess_subj(prep, pred_zoom, uncert_maps)
+
+    bin_prediction = os.path.join(subj_dir, "%s_%s_bin.nii.gz" % (subj, pred_name))
+    nib.save(outputs['bin'], bin_prediction)
+    nib.save(outputs['seg'], prediction)
 
-        if ign_ort is False:
-            check_orient(in_ort, r_orient, l_orient, t1_ort)
+    for uncert_name, uncert_img in outputs['uncertainty'].items():
+        uncert_file = os.path.join(subj_dir, "%s_%s_uncertainty_%s.nii.gz" % (subj, pred_name, uncert_name))
+        nib.save(uncert_img, uncert_file)
 
-        # threshold at 10 percentile of non-zero voxels
-        thresh_file = os.path.join(pred_dir, "%s_thresholded.nii.gz" % os.path.basename(t1).split('.')[0])
-        in_thresh = t1_ort if os.path.exists(t1_ort) else in_ort
-        threshold_img(in_thresh, training_mod, 10, thresh_file)
+    print(colored("\n generating mosaic image for qc", 'green'))
 
-        # standardize
-        std_file = os.path.join(pred_dir, "%s_thresholded_standardized.nii.gz" % os.path.basename(t1).split('.')[0])
-        standard_img(thresh_file, std_file)
+    seg_qc.main(['-i', '%s' % qc_img, '-s', '%s' % prediction, '-d', '1', '-g', '3'])
 
-        # cropping
-        crop_file = os.path.join(pred_dir, "%s_thresholded_standardized_cropped.nii.gz" % os.path.basename(t1).split('.')[0])
-        trim(std_file, crop_file)
+    endstatement.main('Hippocampus prediction (Using MC Dropout) and mosaic generation', '%s' % (datetime.now() - start_time))
 
-        # resample images
-        t1_crop_img = nib.load(crop_file)
-        res = resample(t1_crop_img, [160, 160, 128])
-        res_file = os.path.join(pred_dir, "%s_thresholded_resampled.nii.gz" % os.path.basename(t1).split('.')[0])
-        res.to_filename(res_file)
+    return prediction
 
-        std = nib.load(res_file)
-        test_data = np.zeros((1, 1, 160, 160, 128), dtype=t1_crop_img.get_data_dtype())
-        test_data[0, 0, :, :, :] = std.get_data()
-
-        print(colored("\n predicting initial hippocampus segmentation", 'green'))
-
-        pred = run_test_case(test_data=test_data, model_json=model_json, model_weights=model_weights,
-                             affine=res.affine, output_label_map=True, labels=1)
-
-        # resample back
-        t1_img = t1_ort if os.path.exists(t1_ort) else t1
-        pred_res = resample_to_img(pred, t1_img)
-        pred_th = math_img('img > %s' % thresh, img=pred_res)
 
-        # largest conn comp
-        init_pred_name = os.path.join(pred_dir, "%s_hipp_init_pred.nii.gz" % subj)
-        get_largest_two_comps(pred_th, init_pred_name)
+def postprocess_subj(prep, pred_zoom, uncert_maps):
+    """
+    Bring zoom model prediction (and uncertainty maps) back to the subject space in memory: threshold,
+    two largest components and left / right labels
+    :param prep: pre-processed subject (from prepare_zoom)
+    :param pred_zoom: MC Dropout mean prediction
+    :param uncert_maps: uncertainty images
+    :return: dict of images in subject space: prob (probability), bin (binary segmentation), seg (right: 1,
+     left: 2), uncertainty (dict of uncertainty maps if asked for, else empty)
+    """
+    from hippmapper.utils.reslice_utils import resample_roi
+
+    subj, pred_name, pred_dir, thresh, uncertainty, t1_zoom_img, t1_ref_img = \
+        [prep[key] for key in ('subj', 'pred_name', 'pred_dir', 'thresh', 'uncertainty', 't1_zoom_img',
+                               't1_ref_img')]
+
+    # resample back
+    pred_zoom_res = resample_roi(pred_zoom, t1_zoom_img)
+    save_interm(pred_zoom_res, pred_dir, "%s_trimmed_hipp_pred_prob.nii.gz" % subj)
+
+    # reslice like (linear, as c3d), only over the hippocampal region of the T1
+    pred_zoom_res_t1_img = resample_roi(pred_zoom_res, t1_ref_img, order=1)
+    save_interm(pred_zoom_res_t1_img, pred_dir, "%s_%s_hipp_pred_prob.nii.gz" % (subj, pred_name))
+
+    # thr
+    pred_zoom_th = nib.Nifti1Image((np.asanyarray(pred_zoom_res_t1_img.dataobj) > thresh).astype(np.uint8),
+                                   t1_ref_img.affine)
+
+    # largest 2 conn comp
+    bin_pred_img = get_largest_two_comps(pred_zoom_th)
+
+    # split seg sides
+    seg_img = split_seg_sides(bin_pred_img)
+
+    # uncertainty maps
+    uncert_imgs = {}
+    if uncertainty:
+        for uncert_name, uncert_img in uncert_maps.items():
+            uncert_res = resample_roi(uncert_img, t1_zoom_img)
+            save_interm(uncert_res, pred_dir, "%s_trimmed_hipp_uncertainty_%s.nii.gz" % (subj, uncert_name))
+
+            # expand to original size
+            uncert_imgs[uncert_name] = resample_roi(uncert_res, t1_ref_img, order=1)
+
+    return dict(prob=pred_zoom_res_t1_img, bin=bin_pred_img, seg=seg_img, uncertainty=uncert_imgs)
+
+
+def run_models(preps, subj_batch=None):
+    """
+    Run both models on pre-processed subjects (the hippocampal region is cropped in between), forward passes
+    are batched across subjects (zoom model batches stack subjects x MC samples). A failing subject does not
+    stop the others
+    :param preps: pre-processed subjects (from preprocess_subj) sharing model and MC options
+    :param subj_batch: subjects per stage 1 forward pass (all if None)
+    :return: list of (MC mean prediction, uncertainty images, MC info), or the error of subjects that failed
+    """
+    from hippmapper.deep.predict import run_test_cases, run_mc_test_cases
+
+    results = [None] * len(preps)
+    opts = preps[0]
+
+    print(colored("\n predicting initial hippocampus segmentation", 'green'))
+
+    with stage_memory('stage 1 model'):
+        preds = run_test_cases([prep['test_data'] for prep in preps], model_json=opts['model_json'],
+                               model_weights=opts['model_weights'], affines=[prep['res'].affine for prep in preps],
+                               batch_size=subj_batch, output_label_map=True, labels=1)
+
+    zoom_ids = []
+    with stage_memory('zoom pre-processing'):
+        for subj_id, (prep, pred) in enumerate(zip(preps, preds)):
+            try:
+                prepare_zoom(prep, pred)
+                zoom_ids.append(subj_id)
+            except (Exception, SystemExit) as error:
+                results[subj_id] = error
+
+    if not zoom_ids:
+        return results
+
+    print(colored("\n predicting hippocampus segmentation using MC Dropout with %s samples" % opts['num_mc'],
+                  'green'))
+
+    with stage_memory('MC Dropout model'):
+        mc_results = run_mc_test_cases([preps[subj_id]['test_zoom_data'] for subj_id in zoom_ids],
+                                       model_json=opts['model_zoom_json'], model_weights=opts['model_zoom_weights'],
+                                       affines=[preps[subj_id]['res_zoom'].affine for subj_id in zoom_ids],
+                                       num_mc=opts['num_mc'], batch_size=opts['mc_batch'],
+                                       mc_thresh=opts['thresh'], output_label_map=True, labels=1,
+                                       **opts['adaptive_mc'])
+
+    for subj_id, mc_result in zip(zoom_ids, mc_results):
+        results[subj_id] = mc_result
 
-        # trim seg to size
-        trim_seg = os.path.join(pred_dir, "%s_hipp_init_pred_trimmed.nii.gz" % subj)
-        trim(init_pred_name, trim_seg, voxels=10)
-        #trim_img_to_size(init_pred_name, trim_seg)
+    return results
 
-        # trim t1
-        t1_zoom = os.path.join(pred_dir, "%s_hipp_region.nii.gz" % subj)
-        #trim_like.main(['-i %s' % thresh_file, '-r %s' % trim_seg, '-o %s' % t1_zoom])
-        trim_like(in_thresh, trim_seg, t1_zoom, interp=3)
 
-        # --------------
-        # 2nd model
-        # --------------
+def predict_subjs(preps, subj_batch=None):
+    """
+    Predict hippocampus segmentation of pre-processed subjects (batched across subjects) and save outputs.
+    A failing subject does not stop the others
+    :param preps: pre-processed subjects (from preprocess_subj) sharing model and MC options
+    :param subj_batch: subjects per stage 1 forward pass (all if None)
+    :return: list of prediction files, or the error of subjects that failed
+    """
+    results = run_models(preps, subj_batch=subj_batch)
+
+    for subj_id, result in enumerate(results):
+        if isinstance(result, BaseException):
+            continue
+        try:
+            results[subj_id] = save_subj_outputs(preps[subj_id], *result)
+        except (Exception, SystemExit) as error:
+            results[subj_id] = error
+
+    return results
 
-        pred_shape = [112, 112, 64]
 
-        t1_zoom_img = nib.load(t1_zoom)
-        test_zoom_data = np.zeros((1, 1, pred_shape[0], pred_shape[1], pred_shape[2]),
-                                  dtype=t1_zoom_img.get_data_dtype())
+def predict_subj(prep):
+    """
+    Predict hippocampus segmentation of a pre-processed subject (both models) and save outputs
+    :param prep: pre-processed subject (from preprocess_subj)
+    :return: prediction file
+    """
+    result = predict_subjs([prep])[0]
+    if isinstance(result, BaseException):
+        raise result
 
-        # standardize
-        std_file_trim = os.path.join(pred_dir, "%s_trimmed_standardized.nii.gz"
-                                     % os.path.basename(t1).split('.')[0])
-        #standard_img(t1_zoom, std_file_trim)
-        normalize_sample_wise_img(t1_zoom, std_file_trim)
+    return result
 
-        # resample images
-        t1_img = nib.load(std_file_trim)
-        res_zoom = resample(t1_img, pred_shape)
-        res_file = os.path.join(pred_dir, "%s_trimmed_resampled.nii.gz" % os.path.basename(t1).split('.')[0])
-        res_zoom.to_filename(res_file)
 
-        test_zoom_data[0, 0, :, :, :] = res_zoom.get_data()
+def segment_subj(*subj_inputs, **kwargs):
+    """
+    Segment hippocampus of one subject
+    :param subj_inputs: parsed inputs of subject (from parse_inputs)
+    :param pred_name: prediction name
+    :return: prediction file, whether segmentation was run (False if it already existed)
+    """
+    prediction, prep = preprocess_subj(*subj_inputs, **kwargs)
+    if prep is None:
+        return prediction, False
 
-        model_zoom_json = os.path.join(hyper_dir, 'models', 'hipp_zoom_full_mcdp_model.json')
-        model_zoom_weights = os.path.join(hyper_dir, 'models', 'hipp_zoom_full_mcdp_model_weights.h5')
+    return predict_subj(prep), True
 
-        assert os.path.exists(
-            model_zoom_weights), "%s model does not exits ... please download and rerun script" % model_zoom_weights
 
-        print(colored("\n predicting hippocampus segmentation using MC Dropout with %s samples" % num_mc, 'green'))
+def configure_inference(channels_last=True, frozen=True, quantized=None, tuned=True, mc_batch=None,
+                        intra_threads=None, inter_threads=None, omp_threads=None, cpus=None):
+    """
+    Set random seeds, model variants and session threads for this process (settings saved by hippmapper tune
+    are used unless given)
+    :param channels_last: use channels-last versions of the models when converted
+    :param frozen: use frozen graphs of the models when exported
+    :param quantized: use reduced-precision (float16 or int8) versions of the models (float32 if None)
+    :param tuned: use settings saved by hippmapper tune for this machine
+    :param mc_batch: MC samples per forward pass
+    :param intra_threads: TensorFlow threads within an op
+    :param inter_threads: TensorFlow threads running independent ops
+    :param omp_threads: OpenMP / MKL threads
+    :param cpus: cpus to pin the process to
+    :return: MC samples per forward pass (tuned if not given, None for auto-sizing)
+    """
+    from numpy.random import seed
+    from tensorflow import set_random_seed
+    from hippmapper.deep.predict import prefer_channels_last, prefer_frozen, use_quantized
+    from hippmapper.deep.session import configure_session
+    from hippmapper.deep.tune import load_tuned_config
 
-        pred_zoom_s = np.zeros((num_mc, pred_shape[0], pred_shape[1], pred_shape[2]), dtype=res_zoom.get_data_dtype())
+    seed(1)
+    set_random_seed(1)
 
-        for sample_id in range(num_mc):
-            pred = run_test_case(test_data=test_zoom_data, model_json=model_zoom_json, model_weights=model_zoom_weights,
-                                 affine=res_zoom.affine, output_label_map=True, labels=1)
-            pred_zoom_s[sample_id, :, :, :] = pred.get_data()
-            # nib.save(pred, os.path.join(pred_dir, "hipp_pred_%s.nii.gz" % sample_id))
+    prefer_channels_last(channels_last)
+    prefer_frozen(frozen)
+    use_quantized(quantized)
 
-        pred_zoom_mean = pred_zoom_s.mean(axis=0)
-        # pred_zoom_mean = np.median(pred_zoom_s, axis=0)
-        pred_zoom = nib.Nifti1Image(pred_zoom_mean, res_zoom.affine)
+    # settings saved by hippmapper tune, unless given
+    tuned = load_tuned_config() if tuned else None
+    if tuned is not None:
+        print("\n using tuned settings of this machine: intra threads %s, inter threads %s, MC batch %s" %
+              (tuned['intra_threads'], tuned['inter_threads'], tuned['mc_batch']))
+        mc_batch = tuned['mc_batch'] if mc_batch is None else mc_batch
+        if intra_threads is None and inter_threads is None:
+            intra_threads, inter_threads = tuned['intra_threads'], tuned['inter_threads']
 
-        # resample back
-        pred_zoom_res = resample_to_img(pred_zoom, t1_zoom_img)
-        pred_zoom_name = os.path.join(pred_dir, "%s_trimmed_hipp_pred_prob.nii.gz" % subj)
-        nib.save(pred_zoom_res, pred_zoom_name)
+    if any(opt is not None for opt in (intra_threads, inter_threads, omp_threads, cpus)):
+        configure_session(intra_op_threads=intra_threads, inter_op_threads=inter_threads,
+                          omp_threads=omp_threads, cpus=cpus)
 
-        # reslice like
-        t1_ref = t1_ort if os.path.exists(t1_ort) else t1
+    return mc_batch
 
-        pred_zoom_res_t1 = os.path.join(pred_dir, "%s_%s_hipp_pred_prob.nii.gz" % (subj, pred_name))
-        reslice_like(pred_zoom_name, t1_ref, pred_zoom_res_t1)
 
-        # thr
-        pred_zoom_res_t1_img = nib.load(pred_zoom_res_t1)
-        pred_zoom_th = math_img('img > %s' % thresh, img=pred_zoom_res_t1_img)
+# --------------
+# Main function
+# --------------
+def main(args):
+    """
+    Segment hippocampus using a trained CNN
+    :param args: subj_dir, subj, t1, out, bias, force (or batch)
+    :return: prediction (segmentation file)
+    """
+    parser = parsefn()
+    pred_name = 'T1acq_hipp_pred' if hasattr(args, 'subj') else 'hipp_pred'
+    if isinstance(args, list):
+        args = parser.parse_args(args)
 
-        # largest 2 conn comp
-        # comb_comps_zoom_bin_cmp = os.path.join(pred_dir, "%s_hipp_pred_mean_bin.nii.gz" % subj)
-        bin_prediction = os.path.join(subj_dir, "%s_%s_bin.nii.gz" % (subj, pred_name))
-        get_largest_two_comps(pred_zoom_th, bin_prediction)
+    args.mc_batch = configure_inference(channels_last=not args.channels_first, frozen=not args.no_frozen,
+                                        quantized=args.quantized, tuned=not args.no_tuned, mc_batch=args.mc_batch,
+                                        intra_threads=args.intra_threads, inter_threads=args.inter_threads,
+                                        omp_threads=args.omp_threads, cpus=args.cpus)
 
-        # split seg sides
-        split_seg_sides(bin_prediction, prediction)
+    # stages of subjects overlap in batch mode, peaks are then shared by the stages running together
+    record_stage_memory(args.mem_report)
 
-        # ##### compute and resample entropy uncertainty  ######
-        # pred_zoom_s = np.unique(pred_zoom_s, axis=0)
-        # uncertainty_entropy_ = -1 * np.sum(np.log(pred_zoom_s) * pred_zoom_s, axis=0)
-        # uncertainty_entropy = nib.Nifti1Image(uncertainty_entropy_, res_zoom.affine)
-        #
-        # uncertainty_entropy_res = resample_to_img(uncertainty_entropy, t1_zoom_img)
-        # uncertainty_entropy_name = os.path.join(pred_dir, "%s_trimmed_hipp_uncertainty_entropy.nii.gz" % subj)
-        # nib.save(uncertainty_entropy_res, uncertainty_entropy_name)
-        #
-        # # expand to original size
-        # uncertainty_entropy = os.path.join(subj_dir, "%s_uncertainty_entropy.nii.gz" % subj)
-        # trim_like.main(['-i', '%s' % uncertainty_entropy_name, '-r', '%s' % t1_ref, '-o', '%s' % uncertainty_entropy])
+    if args.batch is not None:
+        status = run_batch(parser, args, pred_name)
+        print_stage_memory()
+        return status
 
-        print(colored("\n generating mosaic image for qc", 'green'))
-
-        seg_qc.main(['-i', '%s' % t1_ref, '-s', '%s' % prediction, '-d', '1', '-g', '3'])
+    prediction, _ = segment_subj(*parse_inputs(parser, args), pred_name=pred_name)
+    print_stage_memory()
 
-        endstatement.main('Hippocampus prediction (Using MC Dropout) and mosaic generation', '%s' % (datetime.now() - start_time))
+    return prediction
 
 
 if __name__ == "__main__":
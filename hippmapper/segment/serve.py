@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import os
+import sys
+import json
+import socket
+import threading
+import traceback
+import argcomplete
+import argparse
+from datetime import datetime
+from http import client as httpclient
+
+# daemon listens on a unix socket only its user can connect to (jobs read and write files as the daemon user)
+SOCKET_NAME = 'hippmapper.sock'
+
+
+def daemon_socket():
+    """
+    Unix socket of this user's segmentation daemon (HIPPMAPPER_SOCKET, else in XDG_RUNTIME_DIR or ~/.hippmapper)
+    :return: socket path
+    """
+    if os.environ.get('HIPPMAPPER_SOCKET'):
+        return os.environ['HIPPMAPPER_SOCKET']
+
+    run_dir = os.environ.get('XDG_RUNTIME_DIR') or os.path.join(os.path.expanduser('~'), '.hippmapper')
+
+    return os.path.join(run_dir, SOCKET_NAME)
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage="%(prog)s \n\n"
+                                           "Run a local segmentation daemon keeping the models loaded, "
+                                           "seg_hipp submits jobs to it when it is running "
+                                           "(only jobs of the same user)\n\n"
+                                           "Examples: \n"
+                                           "    hippmapper serve \n"
+                                           "OR (on another socket, with 8 TensorFlow threads)\n"
+                                           "    hippmapper serve -sk /tmp/me/hippmapper.sock -ita 8 \n")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-sk', '--socket', type=str, metavar='', default=daemon_socket(),
+                          help="unix socket of the daemon (default: %(default)s, or HIPPMAPPER_SOCKET)")
+    optional.add_argument('-ita', '--intra_threads', type=int, metavar='',
+                          help="TensorFlow threads within an op (default: all cores)")
+    optional.add_argument('-ite', '--inter_threads', type=int, metavar='',
+                          help="TensorFlow threads running independent ops (default: TensorFlow default)")
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    return args.socket, args.intra_threads, args.inter_threads
+
+
+# --------------
+# client
+
+
+class UnixHTTPConnection(httpclient.HTTPConnection):
+    """
+    HTTP connection over a unix socket
+    """
+
+    def __init__(self, socket_path, timeout=None):
+        super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def own_socket(socket_path):
+    """
+    Check that a socket exists and belongs to this user (jobs are never sent to another user's daemon)
+    :param socket_path: socket path
+    :return: True if it is a socket of this user
+    """
+    try:
+        stat = os.stat(socket_path)
+    except OSError:
+        return False
+
+    return (stat.st_mode & 0o170000) == 0o140000 and stat.st_uid == os.getuid()
+
+
+def daemon_request(method, path, body=None, socket_path=None, timeout=None):
+    """
+    Send a request to the daemon
+    :param method: GET or POST
+    :param path: /status or /segment
+    :param body: json body (dict)
+    :param socket_path: daemon socket (daemon_socket() if None)
+    :param timeout: seconds to wait for an answer (None to wait until done)
+    :return: json answer (dict)
+    """
+    conn = UnixHTTPConnection(daemon_socket() if socket_path is None else socket_path, timeout=timeout)
+    try:
+        if body is None:
+            conn.request(method, path)
+        else:
+            conn.request(method, path, body=json.dumps(body).encode('utf-8'),
+                         headers={'Content-Type': 'application/json'})
+        return json.loads(conn.getresponse().read().decode('utf-8'))
+    finally:
+        conn.close()
+
+
+def daemon_available(socket_path=None, timeout=0.5):
+    """
+    Check if a segmentation daemon of this user is running
+    :param socket_path: daemon socket (daemon_socket() if None)
+    :param timeout: seconds to wait for an answer
+    :return: True if running
+    """
+    socket_path = daemon_socket() if socket_path is None else socket_path
+    if not own_socket(socket_path):
+        return False
+
+    try:
+        status = daemon_request('GET', '/status', socket_path=socket_path, timeout=timeout)
+    except (OSError, ValueError, httpclient.HTTPException):
+        return False
+
+    return status.get('service') == 'hippmapper' and status.get('uid') == os.getuid()
+
+
+def job_args(args):
+    """
+    seg_hipp arguments that can be sent to the daemon
+    :param args: parsed seg_hipp arguments
+    :return: dict of arguments
+    """
+    return {key: value for key, value in vars(args).items()
+            if value is None or isinstance(value, (str, int, float, bool, list))}
+
+
+def submit(args, socket_path=None):
+    """
+    Submit a seg_hipp job to the running daemon and wait for it (paths are resolved from the current dir)
+    :param args: parsed seg_hipp arguments
+    :param socket_path: daemon socket (daemon_socket() if None)
+    :return: job result (status, result or error, time)
+    """
+    socket_path = daemon_socket() if socket_path is None else socket_path
+    assert own_socket(socket_path), "%s is not a hippmapper daemon socket of this user" % socket_path
+
+    print("\n submitting segmentation to hippmapper daemon on %s" % socket_path)
+    result = daemon_request('POST', '/segment', body={'args': job_args(args), 'cwd': os.getcwd()},
+                            socket_path=socket_path)
+
+    if result['status'] == 'done':
+        print("\n segmentation done in %s: %s" % (result['time'], result['result']))
+    else:
+        print("\n segmentation failed: %s" % result['error'])
+
+    return result
+
+
+# --------------
+# daemon
+
+
+def run_job(job, lock):
+    """
+    Run a seg_hipp job in this process (one job at a time, models stay loaded between jobs)
+    :param job: dict with seg_hipp arguments and working dir of the client
+    :param lock: job lock
+    :return: job result
+    """
+    from hippmapper.segment import hippmapper
+
+    with lock:
+        start_time = datetime.now()
+        cwd = os.getcwd()
+        try:
+            os.chdir(job.get('cwd', cwd))
+            result = hippmapper.main(argparse.Namespace(**job['args']))
+            return {'status': 'done', 'result': result, 'time': str(datetime.now() - start_time)}
+        except (Exception, SystemExit) as error:
+            traceback.print_exc()
+            return {'status': 'failed', 'error': str(error), 'time': str(datetime.now() - start_time)}
+        finally:
+            os.chdir(cwd)
+
+
+def make_handler(lock):
+    from http.server import BaseHTTPRequestHandler
+
+    class JobHandler(BaseHTTPRequestHandler):
+
+        def _reply(self, code, body):
+            data = json.dumps(body, default=str).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/status':
+                self._reply(200, {'service': 'hippmapper', 'busy': lock.locked(), 'pid': os.getpid(),
+                                  'uid': os.getuid()})
+            else:
+                self._reply(404, {'error': 'unknown path %s' % self.path})
+
+        def do_POST(self):
+            if self.path != '/segment':
+                self._reply(404, {'error': 'unknown path %s' % self.path})
+                return
+            try:
+                job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            except ValueError as error:
+                self._reply(400, {'status': 'failed', 'error': 'invalid job: %s' % error})
+                return
+            self._reply(200, run_job(job, lock))
+
+        def address_string(self):
+            # unix socket clients have no address
+            return 'local'
+
+        def log_message(self, format, *args):
+            print("\n %s" % (format % args))
+
+    return JobHandler
+
+
+def load_models():
+    """
+    Load both models (kept in the process-wide model cache)
+    """
+    from hippmapper.deep.predict import load_model
+    from hippmapper.segment.hippmapper import model_files
+
+    model_json, model_weights, model_zoom_json, model_zoom_weights = model_files()
+    load_model(model_json, model_weights)
+    load_model(model_zoom_json, model_zoom_weights)
+
+
+def bind_socket_server(socket_path, handler):
+    """
+    Threaded server on a unix socket only this user can connect to (0600, created under a 0700 dir if missing)
+    :param socket_path: socket path
+    :param handler: request handler class
+    :return: server
+    """
+    from socketserver import ThreadingMixIn, UnixStreamServer
+
+    class ThreadingUnixServer(ThreadingMixIn, UnixStreamServer):
+        daemon_threads = True
+
+    socket_dir = os.path.dirname(os.path.abspath(socket_path))
+    if not os.path.exists(socket_dir):
+        os.makedirs(socket_dir, mode=0o700)
+
+    if os.path.exists(socket_path):
+        assert not daemon_available(socket_path), "a hippmapper daemon is already running on %s" % socket_path
+        assert own_socket(socket_path), "%s exists and is not a socket of this user" % socket_path
+        # stale socket of a daemon that was stopped
+        os.remove(socket_path)
+
+    # socket file is created without group / other permissions
+    umask = os.umask(0o177)
+    try:
+        server = ThreadingUnixServer(socket_path, handler)
+    finally:
+        os.umask(umask)
+    os.chmod(socket_path, 0o600)
+
+    return server
+
+
+def main(args):
+    """
+    Run segmentation daemon on a unix socket of this user
+    :param args: socket, intra_threads, inter_threads
+    """
+    from hippmapper.deep.session import configure_session
+    from hippmapper.deep.tune import load_tuned_config
+
+    parser = parsefn()
+    socket_path, intra_threads, inter_threads = parse_inputs(parser, args)
+
+    # same thread settings as seg_hipp jobs will ask for, so they reuse the session and models
+    tuned = load_tuned_config()
+    if tuned is not None and intra_threads is None and inter_threads is None:
+        intra_threads, inter_threads = tuned['intra_threads'], tuned['inter_threads']
+    if intra_threads is not None or inter_threads is not None:
+        configure_session(intra_op_threads=intra_threads, inter_op_threads=inter_threads)
+
+    print("\n loading models")
+    load_models()
+
+    server = bind_socket_server(socket_path, make_handler(threading.Lock()))
+    print("\n hippmapper daemon listening on %s (ctrl+c to stop)" % socket_path)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n stopping hippmapper daemon")
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import sys
+import time
+import subprocess
+import argcomplete
+import argparse
+
+# modules that should only be imported by the subcommands that need them
+HEAVY_MODULES = ('tensorflow', 'keras', 'PyQt5', 'nilearn', 'nipype', 'SimpleITK', 'scipy', 'pandas')
+
+# cli calls checked, with the heavy modules they may import
+CHECKS = [(['--version'], ()),
+          (['--help'], ()),
+          (['seg_hipp', '--help'], ()),
+          (['stats_hp', '--help'], ('pandas',))]
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage="%(prog)s \n\n"
+                                           "Time the cli start-up in a fresh interpreter and check that heavy "
+                                           "modules (TensorFlow, Qt, nipype ...) are not imported too early\n\n"
+                                           "Examples: \n"
+                                           "    python -m hippmapper.utils.import_time \n"
+                                           "OR (with a 0.5s budget per call)\n"
+                                           "    python -m hippmapper.utils.import_time -b 0.5 \n")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-b', '--budget', type=float, metavar='', default=1.,
+                          help="max start-up time of each cli call in seconds (default: %(default)s)")
+    optional.add_argument('-r', '--repeat', type=int, metavar='', default=3,
+                          help="runs per cli call, the fastest is kept (default: %(default)s)")
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    return args.budget, args.repeat
+
+
+def import_time(cli_args, repeat=3):
+    """
+    Time a fresh interpreter running the cli
+    :param cli_args: cli arguments
+    :param repeat: number of runs (the fastest is kept)
+    :return: best time in seconds, heavy modules that were imported
+    """
+    code = ("import sys\n"
+            "from hippmapper import cli\n"
+            "try:\n"
+            "    cli.main(%r)\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "sys.stderr.write('\\nimported: ' + ' '.join(mod for mod in %r if mod in sys.modules))\n"
+            % (list(cli_args), HEAVY_MODULES))
+
+    times, loaded = [], []
+    for _ in range(repeat):
+        start_time = time.time()
+        proc = subprocess.run([sys.executable, '-c', code], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        times.append(time.time() - start_time)
+        loaded = [line[len('imported:'):].split() for line in proc.stderr.decode('utf-8').splitlines()
+                  if line.startswith('imported:')]
+
+    return min(times), loaded[-1] if loaded else []
+
+
+def main(args):
+    """
+    Check cli start-up time and imports
+    :param args: budget, repeat
+    :return: list of failed checks
+    """
+    parser = parsefn()
+    budget, repeat = parse_inputs(parser, args)
+
+    failed = []
+    for cli_args, allowed in CHECKS:
+        best_time, loaded = import_time(cli_args, repeat=repeat)
+        heavy = [mod for mod in loaded if mod not in allowed]
+
+        print("\n hippmapper %s: %.3fs%s" % (' '.join(cli_args), best_time,
+                                             ", imported %s" % ', '.join(heavy) if heavy else ""))
+
+        if heavy or best_time > budget:
+            failed.append(' '.join(cli_args))
+
+    if failed:
+        print("\n start-up check failed for: %s" % ', '.join(failed))
+        sys.exit(1)
+
+    print("\n start-up check passed")
+
+    return failed
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
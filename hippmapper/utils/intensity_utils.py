@@ -0,0 +1,148 @@
+import numpy as np
+from scipy.ndimage import uniform_filter1d
+
+
+def box_mean(data, radius):
+    """
+    Mean over a box window (zero padded), computed with separable running sums:
+    O(N) regardless of window size
+    :param data: float32 array
+    :param radius: window radius per axis (window size is 2 * radius + 1)
+    :return: box mean (float32)
+    """
+    out = np.asarray(data, dtype=np.float32)
+    for axis, rad in enumerate(radius):
+        out = uniform_filter1d(out, size=2 * int(rad) + 1, axis=axis, mode='constant', cval=0.,
+                               output=np.float32)
+    return out
+
+
+def normalize_local_window(data, radius, mask=None):
+    """
+    Subtract local mean and divide by local standard deviation, with local statistics computed
+    over the mask voxels in a box window around each voxel (native version of c3d -nlw with a mask)
+    :param data: input array
+    :param radius: window radius per axis
+    :param mask: mask array (non-zero voxels of data if None)
+    :return: normalized array (float32), zero outside mask and where the local standard deviation is zero
+    """
+    data = np.asarray(data, dtype=np.float32)
+    mask = (data != 0) if mask is None else (np.asarray(mask) != 0)
+    mask_f = mask.astype(np.float32)
+
+    # shift intensities to improve precision of the float32 variance (shift invariant)
+    shift = data[mask].mean() if mask.any() else 0.
+    centered = (data - shift) * mask_f
+
+    # box means of mask, masked data and masked squared data (window size cancels out)
+    mask_mean = box_mean(mask_f, radius)
+    local_mean = box_mean(centered, radius)
+    centered *= centered
+    local_sq = box_mean(centered, radius)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        local_mean /= mask_mean
+        local_sq /= mask_mean
+        # variances within float32 rounding of zero (e.g. one mask voxel in the window) are zero
+        tiny = local_sq * (16 * np.finfo(np.float32).eps)
+        local_sq -= np.square(local_mean)
+        local_sq[local_sq <= tiny] = 0
+        np.sqrt(local_sq, out=local_sq)
+
+        out = data - shift
+        out -= local_mean
+        out /= local_sq
+
+    out *= mask_f
+    out[~np.isfinite(out)] = 0
+
+    return out
+
+
+def standardize(data):
+    """
+    Subtract mean and divide by standard deviation in place, with mean and variance accumulated in float64
+    in a single pass over the data (no temporaries of the data size)
+    :param data: float32 array (modified in place)
+    :return: standardized array
+    """
+    flat = data.reshape(-1)
+    n = flat.size
+    total = np.add.reduce(flat, dtype=np.float64)
+    total_sq = np.einsum('i,i->', flat, flat, dtype=np.float64)
+
+    mean = total / n
+    std = np.sqrt(max(total_sq / n - mean * mean, 0.))
+
+    data -= mean
+    if std > 0:
+        data /= std
+
+    return data
+
+
+def percentile(data, q, max_exact=2 ** 24, n_bins=4096):
+    """
+    Percentile by selection (np.partition) or, for very large arrays, from a histogram
+    :param data: 1D array
+    :param q: percentile(s) in [0, 100]
+    :param max_exact: largest array size for exact selection
+    :param n_bins: number of histogram bins for approximate percentiles
+    :return: percentile value(s)
+    """
+    q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+    n = data.size
+
+    if n <= max_exact:
+        # linear interpolation between closest ranks (same as np.percentile)
+        pos = q / 100. * (n - 1)
+        lower = np.floor(pos).astype(np.int64)
+        upper = np.minimum(lower + 1, n - 1)
+        part = np.partition(data, np.unique(np.concatenate([lower, upper])))
+        values = part[lower] + (part[upper] - part[lower]) * (pos - lower)
+    else:
+        hist, edges = np.histogram(data, bins=n_bins)
+        cum = np.cumsum(hist)
+        # same closest ranks as above, each placed inside the (non-empty) bin holding it so that
+        # runs of empty bins are only crossed when interpolating between the two ranks
+        pos = q / 100. * (n - 1)
+        lower = np.floor(pos)
+        ranks = np.stack([lower, np.minimum(lower + 1, n - 1)])
+        bins = np.searchsorted(cum, ranks, side='right')
+        rank_pos = (ranks - (cum[bins] - hist[bins]) + 0.5) / hist[bins]
+        rank_values = edges[bins] + rank_pos * (edges[bins + 1] - edges[bins])
+        values = rank_values[0] + (rank_values[1] - rank_values[0]) * (pos - lower)
+
+    return values if values.size > 1 else values[0]
+
+
+def robust_range_value(data, thresh_val, robust=(2, 98)):
+    """
+    Intensity at a percentage of the robust range of non-zero voxels
+    :param data: array
+    :param thresh_val: percentage (0-100) of robust range
+    :param robust: percentiles defining the robust range
+    :return: intensity (None if all voxels are zero)
+    """
+    nonzero = data[data != 0]
+    if nonzero.size == 0:
+        return None
+
+    robust_min, robust_max = percentile(nonzero, robust)
+
+    return robust_min + thresh_val / 100. * (robust_max - robust_min)
+
+
+def robust_range_threshold(data, thresh_val, robust=(2, 98)):
+    """
+    Zero voxels below a percentage of the robust range of non-zero voxels (as fslmaths -thrP), in place
+    :param data: float32 array (modified in place)
+    :param thresh_val: percentage (0-100) of robust range
+    :param robust: percentiles defining the robust range
+    :return: thresholded array
+    """
+    thresh = robust_range_value(data, thresh_val, robust=robust)
+    if thresh is not None:
+        data[data < thresh] = 0
+
+    return data
@@ -0,0 +1,214 @@
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+
+def support_bbox(data, support=0., margin=0):
+    """
+    Bounding box of the voxels above a support value
+    :param data: 3D array
+    :param support: voxels above this value are in the support
+    :param margin: voxels added on each side (clipped to the array)
+    :return: tuple of slices (None if no voxel is above support)
+    """
+    mask = data > support
+    bbox = []
+    for axis in range(mask.ndim):
+        hits = np.flatnonzero(mask.any(axis=tuple(ax for ax in range(mask.ndim) if ax != axis)))
+        if hits.size == 0:
+            return None
+        bbox.append(slice(max(int(hits[0]) - margin, 0), min(int(hits[-1]) + 1 + margin, mask.shape[axis])))
+
+    return tuple(bbox)
+
+
+def map_bbox(bbox, src_affine, ref_affine, ref_shape):
+    """
+    Bounding box in a reference grid covering a bounding box of a source grid
+    :param bbox: tuple of slices in the source grid
+    :param src_affine: source voxel to world affine
+    :param ref_affine: reference voxel to world affine
+    :param ref_shape: reference shape
+    :return: tuple of slices in the reference grid (None if outside of it)
+    """
+    ends = [(sl.start, sl.stop - 1) for sl in bbox]
+    corners = np.array([[ends[0][i], ends[1][j], ends[2][k], 1.]
+                        for i in (0, 1) for j in (0, 1) for k in (0, 1)]).T
+    ref_corners = np.linalg.inv(ref_affine).dot(src_affine).dot(corners)[:3]
+
+    starts = np.maximum(np.floor(ref_corners.min(axis=1)).astype(int), 0)
+    stops = np.minimum(np.ceil(ref_corners.max(axis=1)).astype(int) + 1, ref_shape[:3])
+    if np.any(stops <= starts):
+        return None
+
+    return tuple(slice(int(start), int(stop)) for start, stop in zip(starts, stops))
+
+
+def bbox_affine(affine, bbox):
+    """
+    Affine of a crop of an image
+    :param affine: voxel to world affine of the image
+    :param bbox: tuple of slices (can start outside of the image)
+    :return: voxel to world affine of the crop
+    """
+    crop_affine = np.array(affine, dtype=np.float64)
+    crop_affine[:3, 3] = crop_affine.dot([sl.start for sl in bbox] + [1])[:3]
+
+    return crop_affine
+
+
+def crop_img(img, bbox):
+    """
+    Crop image to a bounding box (data is a view when the box is inside an in-memory image, else zero padded).
+    Images loaded from file are sliced through their array proxy, so only the box is read
+    (partially for uncompressed or indexed gzip files)
+    :param img: input image
+    :param bbox: tuple of slices, can extend outside the image
+    :return: cropped image
+    """
+    shape = img.shape[:3]
+    starts = [sl.start for sl in bbox]
+    stops = [sl.stop for sl in bbox]
+
+    if all(start >= 0 for start in starts) and all(stop <= dim for stop, dim in zip(stops, shape)):
+        crop_data = np.asanyarray(img.dataobj[tuple(bbox)])
+    else:
+        src = tuple(slice(max(start, 0), min(stop, dim)) for start, stop, dim in zip(starts, stops, shape))
+        dst = tuple(slice(sl.start - start, sl.stop - start) for sl, start in zip(src, starts))
+        if all(sl.stop > sl.start for sl in src):
+            src_data = np.asanyarray(img.dataobj[src])
+            crop_data = np.zeros(tuple(stop - start for start, stop in zip(starts, stops)), dtype=src_data.dtype)
+            crop_data[dst] = src_data
+        else:
+            crop_data = np.zeros(tuple(stop - start for start, stop in zip(starts, stops)),
+                                 dtype=img.get_data_dtype())
+
+    crop = nib.Nifti1Image(crop_data, bbox_affine(img.affine, bbox), img.header)
+    crop.set_data_dtype(img.get_data_dtype())
+
+    return crop
+
+
+def trim_img(img, margin=0):
+    """
+    Crop image to the bounding box of its non-zero voxels plus a margin (as c3d -trim, the margin can pad
+    outside the image)
+    :param img: input image
+    :param margin: voxels kept around the non-zero voxels
+    :return: trimmed image (unchanged if all voxels are zero)
+    """
+    bbox = support_bbox(np.asanyarray(img.dataobj))
+    if bbox is None:
+        return img
+
+    return crop_img(img, tuple(slice(sl.start - margin, sl.stop + margin) for sl in bbox))
+
+
+def trim_to_size(img, size):
+    """
+    Crop (or pad) image to a size, centered on the bounding box of its non-zero voxels (as c3d -trim-to-size)
+    :param img: input image
+    :param size: output size in voxels
+    :return: image of the given size
+    """
+    bbox = support_bbox(np.asanyarray(img.dataobj))
+    if bbox is None:
+        bbox = tuple(slice(0, dim) for dim in img.shape[:3])
+
+    starts = [(sl.start + sl.stop - dim) // 2 for sl, dim in zip(bbox, size)]
+
+    return crop_img(img, tuple(slice(start, start + dim) for start, dim in zip(starts, size)))
+
+
+def grid_offset(img, ref_img, tol=1e-3):
+    """
+    Voxel offset of a reference grid in an image grid, when both grids are aligned (same voxel axes and size,
+    origins an integer number of voxels apart)
+    :param img: image
+    :param ref_img: reference image
+    :param tol: tolerance in voxels
+    :return: integer offset of the reference origin in image voxels (None if grids are not aligned)
+    """
+    vox_map = np.linalg.inv(img.affine).dot(ref_img.affine)
+    offset = np.round(vox_map[:3, 3])
+
+    if not np.allclose(vox_map[:3, :3], np.eye(3), atol=tol) or not np.allclose(vox_map[:3, 3], offset, atol=tol):
+        return None
+
+    return offset.astype(int)
+
+
+def reslice_img(img, ref_img, order=1):
+    """
+    Reslice image into the grid of a reference (as c3d -reslice-identity): a crop / pad of the data when grids
+    are aligned, spline interpolation only when they differ
+    :param img: input image
+    :param ref_img: reference image (grid)
+    :param order: spline order if grids differ (0: nearest, 1: linear, 3: cubic)
+    :return: resliced image (input data type if aligned or nearest, else float32)
+    """
+    offset = grid_offset(img, ref_img)
+    if offset is not None:
+        crop = crop_img(img, tuple(slice(start, start + dim) for start, dim in zip(offset, ref_img.shape[:3])))
+        crop.set_sform(ref_img.affine)
+        crop.set_qform(ref_img.affine)
+        return crop
+
+    vox_map = np.linalg.inv(img.affine).dot(ref_img.affine)
+    data = np.asanyarray(img.dataobj)
+    out_dtype = data.dtype if order == 0 else np.float32
+    out_data = ndimage.affine_transform(data, vox_map[:3, :3], offset=vox_map[:3, 3], output_shape=ref_img.shape[:3],
+                                        output=out_dtype, order=order, mode='constant', cval=0.)
+
+    out_img = nib.Nifti1Image(out_data, ref_img.affine, img.header)
+    out_img.set_data_dtype(out_dtype)
+
+    return out_img
+
+
+def resample_roi(src_img, ref_img, order=3, support=0., thresh=None, margin=None):
+    """
+    Resample image onto the grid of a reference, only within the region (bounding box) of the source support:
+    interpolation runs over the region and is pasted into a zero-initialized output of the reference grid
+    :param src_img: source image (e.g. prediction)
+    :param ref_img: reference image (e.g. native T1)
+    :param order: spline order if grids are not aligned (3: as nilearn continuous, 1: linear as c3d reslice,
+     0: nearest)
+    :param support: source voxels above this value define the region (background below it)
+    :param thresh: threshold the resampled values (uint8 mask output) if given
+    :param margin: source voxels added around the support (order + 1 if None)
+    :return: resampled image on the reference grid (float32, uint8 if thresh)
+    """
+    src_data = np.asanyarray(src_img.dataobj)
+    margin = order + 1 if margin is None else margin
+
+    out_dtype = np.float32 if thresh is None else np.uint8
+    out_data = np.zeros(ref_img.shape[:3], dtype=out_dtype)
+
+    src_bbox = support_bbox(src_data, support, margin)
+    ref_bbox = map_bbox(src_bbox, src_img.affine, ref_img.affine, ref_img.shape) if src_bbox is not None else None
+
+    offset = grid_offset(src_img, ref_img) if ref_bbox is not None else None
+
+    if offset is not None:
+        # aligned grids: paste the region without interpolation
+        roi = crop_img(src_img, tuple(slice(sl.start + off, sl.stop + off) for sl, off in zip(ref_bbox, offset)))
+        roi = np.asanyarray(roi.dataobj)
+        out_data[ref_bbox] = roi if thresh is None else roi > thresh
+
+    elif ref_bbox is not None:
+        # reference voxels of the region -> source voxels
+        start = np.eye(4)
+        start[:3, 3] = [sl.start for sl in ref_bbox]
+        vox_map = np.linalg.inv(src_img.affine).dot(ref_img.affine).dot(start)
+
+        roi = ndimage.affine_transform(src_data, vox_map[:3, :3], offset=vox_map[:3, 3],
+                                       output_shape=tuple(sl.stop - sl.start for sl in ref_bbox),
+                                       output=np.float32, order=order, mode='constant', cval=0.)
+
+        out_data[ref_bbox] = roi if thresh is None else roi > thresh
+
+    out_img = nib.Nifti1Image(out_data, ref_img.affine, ref_img.header)
+    out_img.set_data_dtype(out_dtype)
+
+    return out_img
@@ -10,9 +10,18 @@ def sitk_resample_to_spacing(image, new_spacing=(1.0, 1.0, 1.0), interpolator=si
     zoom_factor = np.divide(image.GetSpacing(), new_spacing)
     new_size = np.asarray(np.ceil(np.round(np.multiply(zoom_factor, image.GetSize()), decimals=5)), dtype=np.int16)
     offset = calculate_origin_offset(new_spacing, image.GetSpacing())
-    reference_image = sitk_new_blank_image(size=new_size, spacing=new_spacing, direction=image.GetDirection(),
-                                           origin=image.GetOrigin() + offset, default_value=default_value)
-    return sitk_resample_to_image(image, reference_image, interpolator=interpolator, default_value=default_value)
+
+    # output grid set on the filter (no blank reference image allocated)
+    resample_filter = sitk.ResampleImageFilter()
+    resample_filter.SetInterpolator(interpolator)
+    resample_filter.SetTransform(sitk.Transform())
+    resample_filter.SetOutputPixelType(image.GetPixelID())
+    resample_filter.SetDefaultPixelValue(default_value)
+    resample_filter.SetSize([int(size) for size in new_size])
+    resample_filter.SetOutputSpacing([float(spacing) for spacing in new_spacing])
+    resample_filter.SetOutputOrigin([float(orig) for orig in np.add(image.GetOrigin(), offset)])
+    resample_filter.SetOutputDirection(image.GetDirection())
+    return resample_filter.Execute(image)
 
 
 def sitk_resample_to_image(image, reference_image, default_value=0., interpolator=sitk.sitkLinear, transform=None,
@@ -32,7 +41,7 @@ def sitk_resample_to_image(image, reference_image, default_value=0., interpolato
 
 
 def sitk_new_blank_image(size, spacing, direction, origin, default_value=0.):
-    image = sitk.GetImageFromArray(np.ones(size, dtype=np.float).T * default_value)
+    image = sitk.GetImageFromArray(np.full(np.asarray(size)[::-1], default_value, dtype=np.float32))
     image.SetSpacing(spacing)
     image.SetDirection(direction)
     image.SetOrigin(origin)
@@ -41,28 +50,37 @@ def sitk_new_blank_image(size, spacing, direction, origin, default_value=0.):
 
 def resample_to_spacing(data, spacing, target_spacing, interpolation="linear", default_value=0.):
     image = data_to_sitk_image(data, spacing=spacing)
-    if interpolation is "linear":
+    if interpolation == "linear":
         interpolator = sitk.sitkLinear
-    elif interpolation is "nearest":
+    elif interpolation == "nearest":
         interpolator = sitk.sitkNearestNeighbor
     else:
         raise ValueError("'interpolation' must be either 'linear' or 'nearest'. '{}' is not recognized".format(
             interpolation))
-    resampled_image = sitk_resample_to_spacing(image, new_spacing=target_spacing, interpolator=interpolator,
-                                               default_value=default_value)
+    # axes are resampled independently, so the permuted (z, y, x) image gives the same grid
+    resampled_image = sitk_resample_to_spacing(image, new_spacing=tuple(target_spacing)[::-1],
+                                               interpolator=interpolator, default_value=default_value)
     return sitk_image_to_data(resampled_image)
 
 
 def data_to_sitk_image(data, spacing=(1., 1., 1.)):
-    if len(data.shape) == 3:
-        data = np.rot90(data, 1, axes=(0, 2))
-    image = sitk.GetImageFromArray(data)
-    image.SetSpacing(np.asarray(spacing, dtype=np.float))
+    """
+    SimpleITK image of a (x, y, z) array, handed over as a contiguous float32 buffer without reordering:
+    the C-ordered buffer is read by SimpleITK as a (z, y, x) image, so spacing is given in reversed order
+    (axis permutation instead of a rotated copy)
+    :param data: array (x, y, z)
+    :param spacing: voxel size (x, y, z)
+    :return: SimpleITK image with axes (z, y, x)
+    """
+    image = sitk.GetImageFromArray(np.ascontiguousarray(data, dtype=np.float32))
+    image.SetSpacing([float(spc) for spc in tuple(spacing)[::-1]])
     return image
 
 
 def sitk_image_to_data(image):
-    data = sitk.GetArrayFromImage(image)
-    if len(data.shape) == 3:
-        data = np.rot90(data, -1, axes=(0, 2))
-    return data
\ No newline at end of file
+    """
+    Array of a SimpleITK image from data_to_sitk_image
+    :param image: SimpleITK image with axes (z, y, x)
+    :return: array (x, y, z)
+    """
+    return sitk.GetArrayFromImage(image)
\ No newline at end of file
@@ -0,0 +1,134 @@
+import os
+from contextlib import contextmanager
+
+# peak resident memory per pipeline stage (recorded when not None)
+_STAGE_MEMORY = [None]
+
+
+def available_memory():
+    """
+    Available physical memory
+    :return: available memory in bytes (None if it cannot be determined)
+    """
+    try:
+        with open('/proc/meminfo', 'r') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def total_memory():
+    """
+    Total physical memory
+    :return: total memory in bytes (None if it cannot be determined)
+    """
+    try:
+        with open('/proc/meminfo', 'r') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def cpu_model():
+    """
+    CPU model name (from /proc/cpuinfo, else as reported by the platform)
+    :return: cpu model name
+    """
+    try:
+        with open('/proc/cpuinfo', 'r') as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith('model name'):
+                    return ' '.join(line.split(':', 1)[1].split())
+    except (IOError, OSError):
+        pass
+
+    import platform
+    return platform.processor() or platform.machine() or 'unknown'
+
+
+def reset_peak_rss():
+    """
+    Reset peak resident memory of this process (Linux), so it can be measured per setting
+    :return: True if reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss():
+    """
+    Peak resident memory of this process
+    :return: peak memory in bytes
+    """
+    try:
+        with open('/proc/self/status', 'r') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def record_stage_memory(record=True):
+    """
+    Start (or stop) recording peak resident memory per pipeline stage
+    :param record: record stages run from now on
+    """
+    _STAGE_MEMORY[0] = [] if record else None
+
+
+@contextmanager
+def stage_memory(name):
+    """
+    Record peak resident memory of a pipeline stage (if recording), the peak is reset at the start of the stage
+    when the platform allows it (else the process peak so far is reported)
+    :param name: stage name
+    """
+    records = _STAGE_MEMORY[0]
+    if records is None:
+        yield
+        return
+
+    reset = reset_peak_rss()
+    try:
+        yield
+    finally:
+        records.append((name, peak_rss(), reset))
+
+
+def print_stage_memory():
+    """
+    Print peak resident memory of the recorded stages
+    :return: list of (stage, peak memory in bytes, whether the peak was reset for the stage)
+    """
+    records = _STAGE_MEMORY[0] or []
+    if not records:
+        return records
+
+    width = max(len(name) for name, _, _ in records)
+    print("\n %s  %s" % ('stage'.ljust(width), 'peak memory'))
+    for name, peak, reset in records:
+        print(" %s  %8.0f MB%s" % (name.ljust(width), peak / 1024. ** 2, '' if reset else ' (process peak)'))
+
+    return records
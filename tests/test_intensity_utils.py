@@ -0,0 +1,105 @@
+import numpy as np
+
+from hippmapper.utils.intensity_utils import (normalize_local_window, percentile, robust_range_value,
+                                              robust_range_threshold)
+
+
+def t1_like_volume(shape=(40, 36, 32), seed=0):
+    # background of zeros, skewed intensities in the head and a few bright outliers
+    rng = np.random.RandomState(seed)
+    data = np.zeros(shape, dtype=np.float32)
+    data[5:-5, 4:-4, 3:-3] = rng.gamma(4., 150., size=(shape[0] - 10, shape[1] - 8, shape[2] - 6))
+    data[20, 18, 10:14] = 5000.
+    return data
+
+
+def nlw_reference(data, radius, mask):
+    # brute force: statistics of the mask voxels in the window around each mask voxel (zero padded borders)
+    out = np.zeros(data.shape, dtype=np.float64)
+    for vox in zip(*np.nonzero(mask)):
+        window = tuple(slice(max(v - r, 0), v + r + 1) for v, r in zip(vox, radius))
+        values = data[window][mask[window]].astype(np.float64)
+        std = values.std()
+        out[vox] = (data[vox] - values.mean()) / std if std > 0 else 0.
+    return out
+
+
+def thrp_reference(data, thresh_val):
+    # fslmaths -thrP: threshold below thresh_val % of the robust range (2nd - 98th percentile) of non-zero voxels
+    nonzero = data[data != 0].astype(np.float64)
+    robust_min, robust_max = np.percentile(nonzero, [2, 98])
+    thresh = robust_min + thresh_val / 100. * (robust_max - robust_min)
+    out = data.copy()
+    out[out < thresh] = 0
+    return thresh, out
+
+
+def test_percentile_matches_numpy():
+    data = t1_like_volume().ravel()
+    q = [0, 2, 10, 50, 98, 100]
+    np.testing.assert_allclose(percentile(data, q), np.percentile(data, q), rtol=1e-6)
+    np.testing.assert_allclose(percentile(data[:7], 37.5), np.percentile(data[:7], 37.5), rtol=1e-6)
+
+
+def test_histogram_percentile_with_empty_bins():
+    # two separated modes: most histogram bins in between are empty (flat cdf)
+    rng = np.random.RandomState(1)
+    data = np.concatenate([rng.uniform(0., 1., 5000), rng.uniform(99., 100., 5000)]).astype(np.float32)
+    q = [2, 25, 49.99, 50, 50.01, 75, 98]
+    n_bins = 4096
+    values = percentile(data, q, max_exact=0, n_bins=n_bins)
+
+    assert np.all(np.isfinite(values))
+    assert np.all(np.diff(values) >= 0)
+    np.testing.assert_allclose(values, np.percentile(data, q), atol=2 * (data.max() - data.min()) / n_bins)
+
+
+def test_robust_range_value_matches_thrp_formula():
+    data = t1_like_volume()
+    for thresh_val in (0, 10, 50):
+        thresh, _ = thrp_reference(data, thresh_val)
+        np.testing.assert_allclose(robust_range_value(data, thresh_val), thresh, rtol=1e-5)
+
+
+def test_robust_range_threshold_matches_thrp():
+    data = t1_like_volume()
+    _, expected = thrp_reference(data, 10)
+    out = robust_range_threshold(data.copy(), 10)
+
+    np.testing.assert_array_equal(out != 0, expected != 0)
+    np.testing.assert_array_equal(out, expected)
+
+
+def test_robust_range_threshold_all_zero():
+    data = np.zeros((4, 4, 4), dtype=np.float32)
+    assert robust_range_value(data, 10) is None
+    np.testing.assert_array_equal(robust_range_threshold(data.copy(), 10), data)
+
+
+def test_normalize_local_window_matches_brute_force():
+    rng = np.random.RandomState(2)
+    data = rng.uniform(50., 150., size=(9, 8, 7)).astype(np.float32)
+    mask = rng.uniform(size=data.shape) < 0.6
+    radius = (2, 1, 3)
+
+    out = normalize_local_window(data, radius, mask=mask)
+
+    assert out.dtype == np.float32
+    np.testing.assert_allclose(out, nlw_reference(data, radius, mask), rtol=1e-3, atol=1e-3)
+    assert np.all(out[~mask] == 0)
+
+
+def test_normalize_local_window_empty_windows():
+    # mask from non-zero voxels, with a zero slab wider than the window and a single voxel inside it
+    rng = np.random.RandomState(3)
+    data = rng.uniform(50., 150., size=(16, 8, 7)).astype(np.float32)
+    data[4:12] = 0
+    data[8, 4, 3] = 100.
+    radius = (2, 1, 1)
+
+    out = normalize_local_window(data, radius)
+
+    assert np.all(np.isfinite(out))
+    np.testing.assert_allclose(out, nlw_reference(data, radius, data != 0), rtol=1e-3, atol=1e-3)
+    # windows without mask voxels and a window with only one of them
+    assert np.all(out[4:12] == 0)